@@ -1,8 +1,14 @@
+# importにかかる時間も記録するため、最初に読み込む
+from discordbot.startup import StartupProfile
 import datetime
 import random
 import os
+import pathlib
+import pkgutil
+import time
 from logging import getLogger, StreamHandler, DEBUG, INFO
 import asyncio
+from typing import Optional
 
 from dotenv import load_dotenv
 from discord.ext import commands, tasks
@@ -10,12 +16,21 @@ import discord
 from discord.utils import setup_logging
 
 from discordbot.hot_reload import HotReload
+from discordbot.http_client import HttpClient
+from discordbot.action_queue import ActionQueue
+from discordbot.command_sync import CommandSync
+from discordbot.message_router import MessageRouter
+from discordbot.app_info import ApplicationInfoCache
+from discordbot.ratelimit import TokenBucket
+from discordbot.unfurl_index import UnfurlIndex
+from discordbot.scratch_session import scratch_session
 
 load_dotenv(verbose=True)
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
-from discordbot.templates import limit_command  # noqa: E402
+from discordbot.templates import limit_command, role_index, _command_is_cs_admin  # noqa: E402
+from discordbot.metrics import metrics  # noqa: E402
 
 # Discord.pyのログセットアップ（bot.run()と同じ設定）
 setup_logging(level=INFO)
@@ -32,20 +47,76 @@ intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 
+COGS_DIR = pathlib.Path(__file__).resolve().parent / "cogs"
 
-class RandomStatusTask(commands.Cog):
-    def __init__(self, bot: commands.Bot) -> None:
-        self.bot = bot
-        self.change_status.start()
+startup_profile = StartupProfile()
+startup_profile.mark("import")
+
+
+class PresenceScheduler:
+    # Gatewayへの送信は60秒あたり120回まで
+    GATEWAY_LIMIT = 120
+    GATEWAY_PERIOD = 60.0
+
+    def __init__(self, bot: commands.Bot, share: float = None) -> None:
+        """ステータスの更新をまとめて、Gatewayの送信枠の一部だけを使って反映します
 
-    def cog_unload(self):
-        self.change_status.cancel()
+        再接続のたびにstartを呼んでも、ループは1つだけ動きます。
+        変更の要求は最後のものだけを送信し、表示中と同じ内容の場合は送信しません。
+
+        Args:
+            bot (commands.Bot): 対象のBot
+            share (float, optional): 使用するGateway送信枠の割合。省略時は環境変数'PRESENCE_GATEWAY_SHARE'または0.05
+        """
+        self.bot = bot
+        if share is None:
+            share = float(os.environ.get("PRESENCE_GATEWAY_SHARE", 0.05))
+        if not 0 < share <= 1:
+            raise ValueError("PRESENCE_GATEWAY_SHARE は0より大きく1以下で指定してください")
+
+        rate = self.GATEWAY_LIMIT * share / self.GATEWAY_PERIOD
+        self.bucket = TokenBucket(rate, 1)
+        self._desired: Optional[str] = None
+        self._sent: Optional[str] = None
+        self.update_presence.change_interval(seconds=1 / rate)
+
+    def start(self) -> None:
+        if not self.update_presence.is_running():
+            self.update_presence.start()
+
+    def stop(self) -> None:
+        self.update_presence.cancel()
+
+    def request(self, text: str) -> None:
+        """ステータスの変更を要求します。送信前に再度要求された場合は新しいものだけを送信します。"""
+        if self._desired is not None and self._desired != self._sent:
+            metrics.incr("presence.coalesced")
+        self._desired = text
+
+    @staticmethod
+    def random_text() -> str:
+        return "".join([random.choice(["ク", "ラ", "ウ", "ド"]) for _ in range(4)]) + "システム"
+
+    @tasks.loop(seconds=12.0)
+    async def update_presence(self):
+        self.request(self.random_text())
+
+        text = self._desired
+        if text == self._sent:
+            metrics.incr("presence.skipped")
+            return
+        if not self.bot.is_ready() or self.bot.is_closed():
+            return
 
-    @tasks.loop(seconds=5.0)
-    async def change_status(self):
         try:
-            text = "".join([random.choice(["ク", "ラ", "ウ", "ド"]) for _ in range(4)])
-            await self.bot.change_presence(status=discord.Status.online, activity=discord.Game(text + "システム"))
+            await self.bucket.acquire()
+            activity = discord.Game(text)
+            await self.bot.change_presence(status=discord.Status.online, activity=activity)
+            # 再接続時のIDENTIFYでも同じステータスが送られるようにする
+            self.bot.activity = activity
+            self.bot.status = discord.Status.online
+            self._sent = text
+            metrics.incr("presence.sent")
         except Exception as e:
             logger.error(f"ステータス変更中にエラーが発生しました {e}")
 
@@ -59,7 +130,7 @@ class csApplyStartView(discord.ui.View):
     async def start(self, interaction: discord.Interaction, button: discord.Button) -> None:
         await interaction.response.send_message("DMに内容を送信したので、ご確認ください！", ephemeral=True)
 
-        if discord.utils.get(interaction.user.roles, name="CSuser") is None:
+        if not role_index.member_has_role(interaction.user, "CSuser"):
             embed = discord.Embed(title="管理者応募", description="あなたはまだユーザー認証が完了していないようです。", color=0xf04747)
             await interaction.user.send(embed=embed)
             return
@@ -80,6 +151,24 @@ class csPublicBot:
             intents=intents
         )
         self.tree = self.bot.tree
+        self.command_sync = CommandSync(self.tree)
+
+        # Cogからはbot.http_clientで参照する
+        self.http_client = HttpClient(logger=logger)
+        self.bot.http_client = self.http_client
+        self.action_queue = ActionQueue()
+        self.bot.action_queue = self.action_queue
+        self.unfurl_index = UnfurlIndex()
+        self.bot.unfurl_index = self.unfurl_index
+        role_index.attach(self.bot)
+        self.message_router = MessageRouter()
+        self.bot.message_router = self.message_router
+        self.app_info = ApplicationInfoCache(self.bot)
+        self.bot.app_info = self.app_info
+        self.app_info.attach()
+        # scapiのセッションはCogで閉じず、終了時にまとめて閉じる
+        self.bot.scratch_session = scratch_session
+        self.presence = PresenceScheduler(self.bot)
 
         if cs_server:
             self.cs_server = cs_server
@@ -96,45 +185,76 @@ class csPublicBot:
 
         self.embed_outside = discord.Embed(title="エラー", description="このコマンドは公式サーバーでのみ利用可能です。", color=0xf6a408)
 
-    def _command_is_cs_admin(self, interaction: discord.Interaction):
-        return (interaction.guild is not None and
-                interaction.guild.id == self.discord_cs_server_id and
-                discord.utils.get(interaction.user.roles, name="admin")
-                )
-
     def _register_decorator(self):
         """クラスで定義されたコマンドを登録
         """
 
         # デコレーターを利用せずにイベントを登録
         self.on_ready = self.bot.event(self.on_ready)
-        self.on_message = self.bot.event(self.on_message)
+        self.bot.event(self.message_router.on_message)
+        self.message_router.add_handler("dm_notice", self.on_message)
         self.on_raw_reaction_add = self.bot.event(self.on_raw_reaction_add)
+        self.on_raw_message_delete = self.bot.event(self.on_raw_message_delete)
 
         @self.tree.command(name="cs_apply", description="管理者応募のテンプレートを表示します。")
         @limit_command(only_cloudserver=True)
         async def apply_command(interaction: discord.Interaction):
             embed = discord.Embed(title="管理者応募", description="下のボタンを押して、管理者への応募を始めましょう！", color=0x558aff)
-            if self._command_is_cs_admin(interaction):
+            if _command_is_cs_admin(interaction):
                 await interaction.channel.send(embed=embed, view=self.apply_view)
                 await interaction.response.send_message("↓送信が完了しました", ephemeral=True)
             else:
                 await interaction.response.send_message(embed=embed, view=self.apply_view, ephemeral=True)
 
+        @self.tree.command(name="admin_metrics", description="Botの計測値を表示します。")
+        @limit_command(only_admin=True, only_cloudserver=True)
+        async def metrics_command(interaction: discord.Interaction, prefix: str = ""):
+            lines = metrics.lines(prefix)
+            embed = discord.Embed(title="計測値", description="\n".join(lines)[:4000] or "記録がありません", color=0x558aff)
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+
+        @self.tree.command(name="admin_sync_commands", description="コマンドを強制的に同期します。")
+        @limit_command(only_admin=True, only_cloudserver=True)
+        async def sync_commands_command(interaction: discord.Interaction):
+            await interaction.response.defer(ephemeral=True)
+            synced_commands = await self.command_sync.sync(force=True)
+            await interaction.followup.send(f"{len(synced_commands)}件のコマンドを同期しました", ephemeral=True)
+
     async def _delete_info(self, payload: discord.RawReactionActionEvent):
         """作成した情報の埋め込みを削除
 
+        送信時に記録した対応から判断し、記録より古いメッセージだけAPIから取得して確認します。
+
         Args:
             payload (discord.RawReactionActionEvent): on_raw_reaction_addのペイロード
         """
-        channel = self.bot.get_channel(payload.channel_id)
+        if payload.user_id == self.bot.user.id:
+            return
+
+        channel = self.bot.get_partial_messageable(payload.channel_id)
+        entry = self.unfurl_index.get(payload.message_id)
+        if entry is not None:
+            if entry.author_id is None or entry.author_id == payload.user_id:
+                await channel.get_partial_message(payload.message_id).delete()
+                self.unfurl_index.on_message_deleted(payload.message_id)
+                logger.info(f"埋め込みを削除しました {payload.message_id}")
+            return
+
+        if self.unfurl_index.covers(payload.message_id):
+            logger.debug("削除対象外のメッセージ")
+            return
+
         message = await channel.fetch_message(payload.message_id)
 
         sent_by_me = self.bot.user.id == message.author.id
-        if sent_by_me and message.embeds[0].footer.text != "🗑️リアクションで削除":
+        if not sent_by_me or not message.embeds or message.embeds[0].footer.text != "🗑️リアクションで削除":
             logger.debug("削除対象外の埋め込み")
             return
 
+        if message.reference is None or message.reference.message_id is None:
+            logger.debug("返信元がないため削除しません")
+            return
+
         try:
             ref_message = await channel.fetch_message(message.reference.message_id)
         except discord.errors.NotFound:
@@ -146,8 +266,13 @@ class csPublicBot:
             logger.info(f"埋め込みを削除しました {message.id}")
 
     async def on_ready(self):
-        synced_commands = await self.bot.tree.sync()
-        logger.debug([f"{command.name}: {command.options}" for command in synced_commands])
+        if not startup_profile.reported:
+            startup_profile.mark("connect")
+        synced_commands = await self.command_sync.sync()
+        if synced_commands is not None:
+            logger.debug([f"{command.name}: {command.options}" for command in synced_commands])
+        if not startup_profile.reported:
+            startup_profile.mark("command_sync")
 
         # self.apply_view = csApplyStartView(self.cs_server)
         # self.bot.add_view(self.apply_view)
@@ -158,37 +283,64 @@ class csPublicBot:
         else:
             logger.warning("チャンネルIDが見つかりません")
 
-        RandomStatusTask(self.bot)
+        self.presence.start()
         logger.info("Botの準備ができました！")
+        if not startup_profile.reported:
+            startup_profile.mark("ready")
+            logger.info(startup_profile.report())
 
     async def on_message(self, message: discord.Message):
-        if message.author.bot:
-            return
-
+        """Botの送信したメッセージはMessageRouterで除外済み"""
         if message.guild is None:
             await message.reply(content="メッセージありがとうございます！こちらでのお問い合わせにはお答えできませんのでご了承ください。\n[お問い合わせチャンネル](https://discord.com/channels/1210843458932178994/1256881718766469131)のご利用をお願いします。")
             return
 
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.unfurl_index.on_message_deleted(payload.message_id)
+
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         logger.debug(f"リアクション追加 {payload.emoji.name}")
         if payload.emoji.name == "🗑️":
             await self._delete_info(payload)
 
 
+def discover_extensions() -> list[str]:
+    """cogsディレクトリにあるCogのモジュール名を返します。作業ディレクトリには依存しません。"""
+    return [f"discordbot.cogs.{module.name}" for module in pkgutil.iter_modules([str(COGS_DIR)]) if not module.name.startswith("_")]
+
+
 async def load_extension(public_bot: csPublicBot):
-    for cog in os.listdir("discordbot/cogs"):
-        if cog.endswith(".py"):
-            await public_bot.bot.load_extension(f"discordbot.cogs.{cog[:-3]}")
+    async def load(name: str):
+        start = time.perf_counter()
+        await public_bot.bot.load_extension(name)
+        startup_profile.detail(name, time.perf_counter() - start)
+
+    names = discover_extensions()
+    results = await asyncio.gather(*(load(name) for name in names), return_exceptions=True)
+    errors = [(name, result) for name, result in zip(names, results) if isinstance(result, BaseException)]
+    for name, error in errors:
+        logger.error(f"{name} の読み込みに失敗しました {error}")
+    if errors:
+        raise errors[0][1]
 
 
 async def main():
     public_bot = csPublicBot()
-    await load_extension(public_bot)
-    hot_reload = HotReload(public_bot.bot)
-    await asyncio.gather(
-        public_bot.bot.start(os.environ.get("DISCORD_TOKEN_CSPUBLIC")),
-        hot_reload.watch_files()
-    )
+    await public_bot.http_client.start()
+    startup_profile.mark("setup")
+    try:
+        await load_extension(public_bot)
+        startup_profile.mark("extensions")
+        hot_reload = HotReload(public_bot.bot)
+        startup_profile.mark("hot_reload")
+        await asyncio.gather(
+            public_bot.bot.start(os.environ.get("DISCORD_TOKEN_CSPUBLIC")),
+            hot_reload.watch_files()
+        )
+    finally:
+        await public_bot.action_queue.close()
+        await public_bot.http_client.close()
+        await scratch_session.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+import asyncio
+import time
+from logging import getLogger, StreamHandler, DEBUG
+from typing import Any, Awaitable, Callable, Optional
+
+from discordbot.metrics import metrics
+
+logger = getLogger(__name__)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+
+def channel_bucket(channel_id: int) -> str:
+    """メッセージ送信・スレッド作成のバケット"""
+    return f"channel:{channel_id}"
+
+
+def reaction_bucket(channel_id: int) -> str:
+    """リアクション追加のバケット"""
+    return f"reaction:{channel_id}"
+
+
+def member_bucket(guild_id: int) -> str:
+    """メンバーのロール変更のバケット"""
+    return f"member:{guild_id}"
+
+
+class _Action:
+    __slots__ = ("bucket", "factory", "future", "submitted_at")
+
+    def __init__(self, bucket: str, factory: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.bucket = bucket
+        self.factory = factory
+        self.future = future
+        self.submitted_at = time.perf_counter()
+
+
+class ActionFlow:
+    def __init__(self, queue: "ActionQueue"):
+        """同じ流れの書き込みを、送信した順に1つずつ実行するためのまとまり
+
+        前の書き込みが完了してから次の書き込みをキューに入れます。前の書き込みが失敗した場合、以降の書き込みはキャンセルされます。
+        """
+        self.queue = queue
+        self._last: Optional[asyncio.Future] = None
+
+    def submit(self, bucket: str, factory: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        future = self.queue.submit(bucket, factory, after=self._last)
+        self._last = future
+        return future
+
+    async def wait(self) -> None:
+        """このまとまりの書き込みがすべて終わるまで待ちます"""
+        if self._last is not None:
+            await asyncio.wait([self._last])
+
+
+class ActionQueue:
+    def __init__(self, *, idle_timeout: float = 30.0):
+        """DiscordへのREST書き込みをレート制限のバケットごとにまとめるキュー
+
+        同じバケットの書き込みは順番に、異なるバケットの書き込みは並行して実行します。
+        バケットの処理タスクは、一定時間書き込みがなければ終了します。
+
+        Args:
+            idle_timeout (float, optional): バケットの処理タスクを終了するまでの待機秒数
+        """
+        self.idle_timeout = idle_timeout
+        self._queues: dict[str, asyncio.Queue[_Action]] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self._pending: set[asyncio.Task] = set()
+
+    def depth(self, bucket: Optional[str] = None) -> int:
+        """実行待ちの書き込みの数"""
+        if bucket is not None:
+            queue = self._queues.get(bucket)
+            return queue.qsize() if queue else 0
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def flow(self) -> ActionFlow:
+        return ActionFlow(self)
+
+    def submit(self, bucket: str, factory: Callable[[], Awaitable[Any]], *, after: Optional[asyncio.Future] = None) -> asyncio.Future:
+        """書き込みをキューに入れます
+
+        Args:
+            bucket (str): レート制限のバケット
+            factory (Callable[[], Awaitable[Any]]): 実行時に呼び出す、書き込みのコルーチンを返す関数
+            after (Optional[asyncio.Future], optional): この書き込みの成功後にキューに入れる。失敗した場合はキャンセルする
+
+        Returns:
+            asyncio.Future: 書き込みの結果
+        """
+        future = asyncio.get_running_loop().create_future()
+        # 結果を待たない書き込みの例外も取り出しておく
+        future.add_done_callback(self._retrieve)
+        action = _Action(bucket, factory, future)
+        metrics.incr("action_queue.submitted")
+
+        if after is None:
+            self._enqueue(action)
+        else:
+            task = asyncio.create_task(self._enqueue_after(after, action))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+        return future
+
+    async def run(self, bucket: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """書き込みをキューに入れ、結果を待ちます"""
+        return await self.submit(bucket, factory)
+
+    @staticmethod
+    def _retrieve(future: asyncio.Future) -> None:
+        if not future.cancelled():
+            future.exception()
+
+    async def _enqueue_after(self, after: asyncio.Future, action: _Action) -> None:
+        await asyncio.wait([after])
+        if after.cancelled() or after.exception() is not None:
+            action.future.cancel()
+            return
+        self._enqueue(action)
+
+    def _enqueue(self, action: _Action) -> None:
+        queue = self._queues.get(action.bucket)
+        if queue is None:
+            queue = self._queues[action.bucket] = asyncio.Queue()
+        queue.put_nowait(action)
+        if action.bucket not in self._workers:
+            self._workers[action.bucket] = asyncio.create_task(self._work(action.bucket, queue))
+        metrics.gauge("action_queue.depth", self.depth())
+
+    async def _work(self, bucket: str, queue: asyncio.Queue[_Action]) -> None:
+        try:
+            while True:
+                try:
+                    action = await asyncio.wait_for(queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        return
+                    continue
+
+                metrics.observe("action_queue.wait", time.perf_counter() - action.submitted_at)
+                metrics.gauge("action_queue.depth", self.depth())
+                if action.future.cancelled():
+                    continue
+
+                try:
+                    result = await action.factory()
+                except Exception as e:
+                    metrics.incr("action_queue.failed")
+                    logger.warning(f"書き込みに失敗しました バケット: {bucket} {e}")
+                    if not action.future.done():
+                        action.future.set_exception(e)
+                else:
+                    if not action.future.done():
+                        action.future.set_result(result)
+        finally:
+            self._workers.pop(bucket, None)
+            if queue.empty():
+                self._queues.pop(bucket, None)
+
+    async def close(self) -> None:
+        """実行中の処理タスクを止めます。実行待ちの書き込みはキャンセルされます。"""
+        tasks = list(self._workers.values()) + list(self._pending)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for queue in self._queues.values():
+            while not queue.empty():
+                queue.get_nowait().future.cancel()
+        self._queues.clear()
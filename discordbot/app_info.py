@@ -0,0 +1,51 @@
+from typing import Optional
+
+import discord
+from discord.ext import commands
+
+from discordbot.cache import TTLCache
+
+
+class ApplicationInfoCache:
+    def __init__(self, bot: commands.Bot, *, ttl: float = 60 * 60):
+        """application_infoの結果を保持します
+
+        TTLを過ぎた後は古い値を返しつつ取得し直し、再接続時やBotのアバターの変更時には破棄します。
+
+        Args:
+            bot (commands.Bot): 対象のBot
+            ttl (float, optional): 取得し直すまでの秒数
+        """
+        self.bot = bot
+        self._cache = TTLCache(maxsize=1, ttl=ttl, stale_ttl=24 * 60 * 60)
+        self._avatar: Optional[str] = None
+
+    def _current_avatar(self) -> Optional[str]:
+        if self.bot.user is None or self.bot.user.avatar is None:
+            return None
+        return self.bot.user.avatar.key
+
+    async def get(self) -> discord.AppInfo:
+        # アバターの変更はUSER_UPDATEでbot.userに反映されるため、RESTを呼ばずに比較できる
+        avatar = self._current_avatar()
+        if avatar != self._avatar:
+            self.invalidate()
+            self._avatar = avatar
+        return await self._cache.get_or_fetch("app_info", self.bot.application_info)
+
+    async def icon_url(self) -> Optional[str]:
+        """アプリケーションのアイコンのURL。未設定の場合はBotのアバターのURL"""
+        app_info = await self.get()
+        if app_info.icon is not None:
+            return app_info.icon.url
+        return self.bot.user.display_avatar.url if self.bot.user else None
+
+    def invalidate(self) -> None:
+        self._cache.invalidate("app_info")
+
+    async def on_ready(self) -> None:
+        self.invalidate()
+
+    def attach(self) -> None:
+        """Botのイベントに登録します"""
+        self.bot.add_listener(self.on_ready)
@@ -0,0 +1,112 @@
+"""ScratchAuthのAPI(auth-api.itinerary.eu.org)の代わりに使うローカルサーバー
+
+遅延や失敗を再現できるため、認証APIのタイムアウトやサーキットブレーカーの確認に使えます。
+'SCRATCH_AUTH_API_URL'にこのサーバーのURLを指定してBotを起動します。
+
+    python -m discordbot.auth_stub --port 8787 --latency 0.5 --failure-rate 0.2 --auto-approve
+"""
+import argparse
+import asyncio
+import base64
+import random
+import secrets
+from dataclasses import dataclass
+from typing import Optional
+
+from aiohttp import web
+
+
+@dataclass
+class StubToken:
+    public_code: str
+    private_code: str
+    redirect: str
+    method: str
+    username: Optional[str] = None
+    approved_by: Optional[str] = None
+
+
+class AuthStub:
+    def __init__(self, *, latency: float = 0.0, failure_rate: float = 0.0, auto_approve: bool = False, username: str = "scratchcat"):
+        """
+        Args:
+            latency (float, optional): 応答までの遅延(秒)
+            failure_rate (float, optional): 503を返す割合
+            auto_approve (bool, optional): Trueの場合、発行したトークンをすべて認証済みにします
+            username (str, optional): 自動で認証済みにするときのユーザー名
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.auto_approve = auto_approve
+        self.username = username
+        self.tokens: dict[str, StubToken] = {}
+        self.requests = 0
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.path.startswith("/auth/") and random.random() < self.failure_rate:
+            return web.json_response({"error": "stub failure"}, status=503)
+        return await handler(request)
+
+    async def get_tokens(self, request: web.Request) -> web.Response:
+        try:
+            redirect = base64.urlsafe_b64decode(request.query["redirect"]).decode()
+        except (KeyError, ValueError):
+            return web.json_response({"error": "invalid redirect"}, status=400)
+
+        token = StubToken(
+            public_code=secrets.token_hex(4),
+            private_code=secrets.token_hex(16),
+            redirect=redirect,
+            method=request.query.get("method", "cloud"),
+            username=request.query.get("username"),
+        )
+        if self.auto_approve:
+            token.approved_by = token.username or self.username
+        self.tokens[token.private_code] = token
+        return web.json_response({
+            "publicCode": token.public_code,
+            "privateCode": token.private_code,
+            "redirectLocation": token.redirect,
+            "method": token.method,
+            "authProject": request.query.get("authProject"),
+        })
+
+    async def verify_token(self, request: web.Request) -> web.Response:
+        # 本物と同じく、検証したトークンは消費される
+        token = self.tokens.pop(request.match_info["private_code"], None)
+        if token is None or token.approved_by is None:
+            return web.json_response({"valid": False, "username": None, "redirect": None}, status=403)
+        return web.json_response({"valid": True, "username": token.approved_by, "redirect": token.redirect})
+
+    async def approve(self, request: web.Request) -> web.Response:
+        """公開コードを入力したことにします"""
+        public_code = request.match_info["public_code"]
+        for token in self.tokens.values():
+            if token.public_code == public_code:
+                token.approved_by = request.query.get("username") or token.username or self.username
+                return web.json_response({"approved": True})
+        return web.json_response({"approved": False}, status=404)
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get("/auth/getTokens/", self.get_tokens)
+        app.router.add_get("/auth/verifyToken/{private_code}", self.verify_token)
+        app.router.add_post("/stub/approve/{public_code}", self.approve)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ScratchAuthのAPIの代わりに使うローカルサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=0.0, help="応答までの遅延(秒)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="503を返す割合")
+    parser.add_argument("--auto-approve", action="store_true", help="発行したトークンをすべて認証済みにする")
+    args = parser.parse_args()
+
+    stub = AuthStub(latency=args.latency, failure_rate=args.failure_rate, auto_approve=args.auto_approve)
+    web.run_app(stub.create_app(), host=args.host, port=args.port)
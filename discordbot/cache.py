@@ -0,0 +1,156 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from logging import getLogger, StreamHandler, DEBUG
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+logger = getLogger(__name__)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    stale_hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    evictions: int = 0
+    refresh_errors: int = 0
+
+    def to_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+
+@dataclass
+class _Entry:
+    value: Any
+    fresh_until: float
+    stale_until: float
+
+
+class TTLCache:
+    def __init__(self, *, maxsize: int = 512, ttl: float = 600.0, ttls: Optional[dict[Hashable, float]] = None,
+                 stale_ttl: float = 3600.0):
+        """TTLとLRUで管理するメモリ上のキャッシュ
+
+        キーはタプルで、先頭の要素ごとにTTLを変えられます。
+        TTLを過ぎてもstale_ttlの間は古い値を返しつつ、裏で取得し直します。
+        同じキーの取得が同時に走った場合は、1つのリクエストを共有します。
+
+        Args:
+            maxsize (int, optional): 保持する最大件数。超えた場合は最も使われていないものから削除
+            ttl (float, optional): 既定のTTL(秒)
+            ttls (dict, optional): キーの先頭要素ごとのTTL(秒)
+            stale_ttl (float, optional): TTL切れの値を返してよい追加の秒数
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.stale_ttl = stale_ttl
+        self.stats = CacheStats()
+
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _ttl_for(self, key: Hashable) -> float:
+        if isinstance(key, tuple) and key:
+            return self.ttls.get(key[0], self.ttl)
+        return self.ttl
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        now = time.monotonic()
+        fresh_until = now + self._ttl_for(key)
+        self._entries[key] = _Entry(value=value, fresh_until=fresh_until, stale_until=fresh_until + self.stale_ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def peek(self, key: Hashable, *, allow_stale: bool = True) -> Optional[Any]:
+        """取得を行わずにキャッシュの値だけを返します"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        now = time.monotonic()
+        if now < entry.fresh_until or (allow_stale and now < entry.stale_until):
+            return entry.value
+        return None
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def _start_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats.coalesced += 1
+            return task
+
+        async def runner():
+            try:
+                value = await fetch()
+                self._store(key, value)
+                return value
+            finally:
+                self._inflight.pop(key, None)
+
+        task = asyncio.create_task(runner())
+        self._inflight[key] = task
+        return task
+
+    def _refresh_in_background(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> None:
+        if key in self._inflight:
+            return
+
+        task = self._start_fetch(key, fetch)
+
+        def done(t: asyncio.Task):
+            if not t.cancelled() and t.exception() is not None:
+                self.stats.refresh_errors += 1
+                logger.warning(f"キャッシュの再取得に失敗しました {key}: {t.exception()}")
+
+        task.add_done_callback(done)
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """キャッシュから取得し、なければfetchを呼び出して保存します
+
+        Args:
+            key (Hashable): キャッシュのキー
+            fetch (Callable[[], Awaitable[Any]]): 値を取得するコルーチン関数
+
+        Returns:
+            Any: キャッシュされた値、または取得した値
+        """
+        entry = self._entries.get(key)
+        now = time.monotonic()
+
+        if entry is not None:
+            if now < entry.fresh_until:
+                self.stats.hits += 1
+                self._entries.move_to_end(key)
+                return entry.value
+
+            if now < entry.stale_until:
+                self.stats.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._refresh_in_background(key, fetch)
+                return entry.value
+
+            self._entries.pop(key, None)
+
+        self.stats.misses += 1
+        # 待機側がキャンセルされても共有中の取得は止めない
+        return await asyncio.shield(self._start_fetch(key, fetch))
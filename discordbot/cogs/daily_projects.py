@@ -1,18 +1,32 @@
+from __future__ import annotations  # scapiを遅延読み込みするため、型アノテーションを評価しない
 import os
 import datetime
 from logging import getLogger, StreamHandler, DEBUG
 import random
 import time
+import asyncio
+from typing import AsyncIterator, Optional
+from dataclasses import dataclass, field
 
+import discord
 from discord.ext import commands, tasks
 from discord import app_commands, Interaction
-import requests
-import scapi
+import aiohttp
 
 from discordbot.cogs.scratch_info import ScratchInfo
+from ..lazy_import import lazy_import
 from ..templates import limit_command
+from ..ratelimit import TokenBucket
+from ..storage import data_path
+from ..scratch_session import scratch_session
+from ..project_index import ProjectIndex, IndexedProject
+from ..daily_history import DailyHistory
+from ..action_queue import ActionQueue, channel_bucket, reaction_bucket
 
 
+# 起動時の読み込みを軽くするため、最初に使うときに読み込む
+scapi = lazy_import("scapi")
+
 logger = getLogger(__name__)
 handler = StreamHandler()
 handler.setLevel(DEBUG)
@@ -21,6 +35,21 @@ logger.addHandler(handler)
 logger.propagate = False
 
 
+@dataclass
+class CandidatePool:
+    """事前に作成した今日の作品の候補"""
+    candidates: list[IndexedProject]
+    weights: list[int]
+    embeds: dict[int, discord.Embed]
+    built_at: float
+    # 埋め込みを作成した時刻。古いものは作り直す
+    rendered_at: dict[int, float] = field(default_factory=dict)
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.built_at
+
+
 JST = datetime.timezone(datetime.timedelta(hours=9))
 
 # 宣伝をする時刻
@@ -42,43 +71,190 @@ class DailyProjects(commands.Cog):
 
         self.max_applies = 20
 
+        # 審査状況を確認するワーカー数と、1秒あたりのリクエスト数
+        self.scan_workers = 8
+        self.scan_rate = TokenBucket(rate=10, capacity=10)
+
+        # スタジオの作品のインデックスと、審査状況を確認し直すまでの秒数
+        self.project_index = ProjectIndex(data_path("daily_projects.sqlite3"))
+        self.revalidate_age = 3 * 24 * 60 * 60
+
+        # APIの履歴のローカルの写しと、登録待ちのoutbox
+        self.history = DailyHistory(data_path("daily_history.sqlite3"))
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+        # 事前に作成しておく候補と、その場でスキャンし直すまでの秒数
+        self.pool: Optional[CandidatePool] = None
+        self.pool_max_age = 2 * 60 * 60
+        self.render_concurrency = 4
+        # 事前に作成する埋め込みの最大数と、作り直すまでの秒数
+        self.prerender_limit = 20
+        self.embed_max_age = 3 * 60 * 60
+        self._pool_lock = asyncio.Lock()
+
         # self.bot.tree.add_command(self.decide_command)
         self.run.start()
-
-    def cog_unload(self):
-        self.run.cancel()
+        self.outbox_loop.start()
+        self.refresh_pool.start()
+
+    async def cog_unload(self):
+        loops = [self.run, self.outbox_loop, self.refresh_pool]
+        running = [task for task in [loop.get_task() for loop in loops] + [self._flush_task] if task is not None and not task.done()]
+        for loop in loops:
+            loop.cancel()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        # 実行中の処理が閉じたデータベースを使わないよう、終わるのを待ってから閉じる
+        await asyncio.gather(*running, return_exceptions=True)
+        self.project_index.close()
+        self.history.close()
 
     @tasks.loop(time=start_times)
     async def run(self):
         await self.decide_daily_project()
 
-    async def decide_daily_project(self, mention: bool = True):
-        studio: scapi.Studio = await scapi.get_studio(self.studio_id)
+    async def _check_statuses(self, source: AsyncIterator[int], timings: dict[str, float],
+                              client_session: scapi.ClientSession) -> dict[int, Optional[str]]:
+        """作品の審査状況を並行して確認します
+
+        sourceの取得(ページ送りなど)を続けながら、取得済みのIDをワーカーで確認します。
+
+        Args:
+            source (AsyncIterator[int]): 確認する作品IDを返すイテレーター
+            timings (dict[str, float]): 各段階の所要時間(秒)の記録先
+            client_session (scapi.ClientSession): 確認に使うセッション
+
+        Returns:
+            dict[int, Optional[str]]: 作品IDと審査状況。作品が見つからなかった場合はNone。一時的な失敗で確認できなかった作品は含まない
+        """
+        queue: asyncio.Queue[Optional[int]] = asyncio.Queue(maxsize=self.scan_workers * 4)
+        results: dict[int, Optional[str]] = {}
+        failed: list[int] = []
+        lookup_time = 0.0
+
+        async def produce():
+            start = time.perf_counter()
+            async for project_id in source:
+                await queue.put(project_id)
+            timings["pagination"] = time.perf_counter() - start
+            for _ in range(self.scan_workers):
+                await queue.put(None)
+
+        async def check_status():
+            nonlocal lookup_time
+            while (project_id := await queue.get()) is not None:
+                await self.scan_rate.acquire()
+                start = time.perf_counter()
+                try:
+                    project_remixtree = await scapi.get_remixtree(project_id, ClientSession=client_session)
+                    results[project_id] = project_remixtree.moderation_status
+                except scapi.exception.ObjectNotFound:
+                    # 一応そのまま流す（たぶんエラーの方が多い）
+                    logger.warning(f"ステータス取得失敗 {project_id}")
+                    results[project_id] = None
+                except (scapi.exception.HTTPError, scapi.exception.ObjectFetchError, aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                    # 429などの一時的な失敗で全体を止めず、この作品は次回確認し直す
+                    logger.warning(f"ステータスを確認できませんでした {project_id} {e!r}")
+                    failed.append(project_id)
+                finally:
+                    lookup_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        workers = [asyncio.create_task(produce())] + [asyncio.create_task(check_status()) for _ in range(self.scan_workers)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for worker in workers:
+                worker.cancel()
+            raise
+        timings["scan"] = time.perf_counter() - start
+        timings["moderation_lookup_total"] = lookup_time
+        if failed:
+            logger.warning(f"審査状況を確認できなかった作品: {len(failed)}件 (次回確認し直します)")
+
+        return results
+
+    async def refresh_index(self, studio: scapi.Studio, timings: dict[str, float], *, full: bool = False) -> None:
+        """スタジオの作品をローカルのインデックスに反映します
+
+        通常は前回以降に追加された作品だけを取得し、審査状況は確認から時間がたったものだけ確認し直します。
+
+        Args:
+            studio (scapi.Studio): 対象のスタジオ
+            timings (dict[str, float]): 各段階の所要時間(秒)の記録先
+            full (bool, optional): Trueの場合、すべての作品を取得し直します
+        """
+        known_ids = self.project_index.known_ids(self.studio_id)
+        full = full or not known_ids
+        stale_ids = [] if full else self.project_index.stale_ids(self.studio_id, self.revalidate_age)
+        new_projects: list[IndexedProject] = []
+
+        async def source():
+            # projectsは新しい順に返されるので、既知の作品まで来たら以降はすべて取得済み
+            async for project in studio.projects(limit=studio.project_count):
+                if not full and project.id in known_ids:
+                    break
+                new_projects.append(IndexedProject(id=project.id, author=project.author.username, title=project.title))
+                yield project.id
+            for project_id in stale_ids:
+                yield project_id
+
+        statuses = await self._check_statuses(source(), timings, studio.ClientSession)
+        checked_at = time.time()
+        for project in new_projects:
+            # 確認できなかった作品はchecked_atを0のままにし、次回確認し直す
+            if project.id in statuses:
+                project.moderation_status = statuses.pop(project.id)
+                project.checked_at = checked_at
+
+        self.project_index.add_projects(self.studio_id, new_projects, replace=full)
+        self.project_index.update_statuses(self.studio_id, statuses.items(), checked_at)
+        logger.info(f"インデックス更新 {'全件' if full else '差分'}: 追加 {len(new_projects)}件, 再確認 {len(statuses)}件")
+
+        # スタジオから削除された作品は差分では検出できないため、件数が合わなければ作り直す
+        if not full and self.project_index.count(self.studio_id) != studio.project_count:
+            logger.info("スタジオの作品数が一致しないため、インデックスを作り直します")
+            await self.refresh_index(studio, timings, full=True)
+
+    async def build_candidate_pool(self) -> Optional[CandidatePool]:
+        """スタジオと履歴を更新し、候補と埋め込みを作成します
+
+        Returns:
+            Optional[CandidatePool]: 作成した候補。履歴を取得できなかった場合はNone
+        """
+        timings: dict[str, float] = {}
+        start = time.perf_counter()
+        studio: scapi.Studio = await scapi.get_studio(self.studio_id, ClientSession=scratch_session.get())
         await studio.update()
-
-        past_res = requests.get(self.api_url)
-        if not past_res.headers["Content-Type"].startswith("application/json") or past_res.json()["code"] != 200:
-            logger.error("API側でエラーが発生しました")
-            logger.debug(past_res.text)
-            return
-
-        past_projects = set(int(data["id"]) for data in past_res.json()["data"])
+        timings["studio"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            added = await self.history.sync(self.bot.http_client, self.api_url)
+            logger.debug(f"履歴を同期しました 追加: {added}件")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError, ValueError, KeyError) as e:
+            if not self.history.count():
+                logger.error(f"履歴を取得できませんでした {e}")
+                return None
+            logger.warning(f"履歴の同期に失敗したため、ローカルの履歴を利用します {e}")
+        timings["history"] = time.perf_counter() - start
+
+        past_projects = self.history.featured_ids()
         applies = {}
 
-        projects_candidate: list[scapi.Project] = []
+        projects_candidate: list[IndexedProject] = []
         projects_weight = []
 
-        # projectsは新しい順に返される
-        async for project in studio.projects(limit=studio.project_count):
-            try:
-                project_remixtree = await project.get_remixtree()
-                if project_remixtree.moderation_status == "notsafe":
-                    continue
-            except scapi.exception.ObjectNotFound:
-                # 一応そのまま流す（たぶんエラーの方が多い）
-                logger.warning(f"ステータス取得失敗 {project.id}")
+        await self.refresh_index(studio, timings)
+        for project in self.project_index.list_projects(self.studio_id):
+            if project.moderation_status == "notsafe":
+                continue
+            # 審査状況をまだ確認できていない作品は、確認できるまで候補にしない
+            if not project.checked_at:
+                continue
 
-            project_author: str = project.author.username
+            project_author: str = project.author
             if project_author not in applies:
                 applies[project_author] = 0
 
@@ -94,10 +270,104 @@ class DailyProjects(commands.Cog):
             projects_candidate.append(project)
             projects_weight.append(1)
 
+        start = time.perf_counter()
+        embeds, rendered_at = await self._render_embeds(projects_candidate)
+        timings["render"] = time.perf_counter() - start
+
+        logger.info("候補作成の所要時間: " + ", ".join(f"{name}={value:.2f}s" for name, value in timings.items()))
+        return CandidatePool(candidates=projects_candidate, weights=projects_weight, embeds=embeds, built_at=time.time(), rendered_at=rendered_at)
+
+    async def _render_embed(self, project_id: int) -> Optional[discord.Embed]:
+        """作品の埋め込みを作成します
+
+        展開用のキャッシュを候補で埋めないよう、info_cacheを通さずに取得します。
+        """
+        await self.scan_rate.acquire()
+        try:
+            scratch_info = ScratchInfo(type="projects", id=project_id)
+            scratch_info._set_data(await scratch_info._fetch())
+            return scratch_info.get_embed(can_delete=False)
+        except (ValueError, scapi.exception.ObjectFetchError, scapi.exception.HTTPError, aiohttp.ClientError, asyncio.TimeoutError):
+            logger.warning(f"埋め込みの作成に失敗しました {project_id}")
+            return None
+
+    async def _render_embeds(self, projects: list[IndexedProject]) -> tuple[dict[int, discord.Embed], dict[int, float]]:
+        """候補のうち最大prerender_limit件の埋め込みを事前に作成します
+
+        Returns:
+            tuple[dict[int, discord.Embed], dict[int, float]]: 作品IDごとの埋め込みと、その作成時刻
+        """
+        # 前回のプールで作成済みのもののうち、新しいものは使い回す
+        now = time.time()
+        previous = self.pool
+        embeds: dict[int, discord.Embed] = {}
+        rendered_at: dict[int, float] = {}
+        if previous is not None:
+            for project in projects:
+                created = previous.rendered_at.get(project.id)
+                if created is not None and now - created < self.embed_max_age and project.id in previous.embeds:
+                    embeds[project.id] = previous.embeds[project.id]
+                    rendered_at[project.id] = created
+
+        # すべての候補を作成するとScratchへの問い合わせが集中するため、一部だけ作成する
+        missing = [project for project in projects if project.id not in embeds]
+        targets = random.sample(missing, min(len(missing), max(0, self.prerender_limit - len(embeds))))
+        semaphore = asyncio.Semaphore(self.render_concurrency)
+
+        async def render(project: IndexedProject) -> Optional[discord.Embed]:
+            async with semaphore:
+                return await self._render_embed(project.id)
+
+        rendered = await asyncio.gather(*[render(project) for project in targets])
+        rendered_now = time.time()
+        for project, embed in zip(targets, rendered):
+            if embed is not None:
+                embeds[project.id] = embed
+                rendered_at[project.id] = rendered_now
+        return embeds, rendered_at
+
+    async def update_pool(self) -> Optional[CandidatePool]:
+        async with self._pool_lock:
+            pool = await self.build_candidate_pool()
+            if pool is not None:
+                self.pool = pool
+            return pool
+
+    @tasks.loop(minutes=30)
+    async def refresh_pool(self):
+        try:
+            pool = await self.update_pool()
+            if pool is not None:
+                logger.debug(f"候補プールを更新しました {len(pool.candidates)}件")
+        except Exception as e:
+            logger.error(f"候補プールの更新中にエラーが発生しました {e}")
+
+    def pool_status(self) -> str:
+        if self.pool is None:
+            return "未作成"
+        return f"{len(self.pool.candidates)}件, 埋め込み{len(self.pool.embeds)}件, 作成から{self.pool.age / 60:.0f}分"
+
+    async def decide_daily_project(self, mention: bool = True):
+        pool = self.pool
+        if pool is None or pool.age > self.pool_max_age:
+            logger.info(f"候補プールが使えないため、その場でスキャンします ({self.pool_status()})")
+            pool = await self.update_pool()
+            if pool is None:
+                return
+
+        # プール作成後に掲載されたものは除外する
+        past_projects = self.history.featured_ids()
+        projects_candidate: list[IndexedProject] = []
+        projects_weight = []
+        for project, weight in zip(pool.candidates, pool.weights):
+            if project.id not in past_projects:
+                projects_candidate.append(project)
+                projects_weight.append(weight)
+
         if not projects_candidate:
             logger.info("対象作品なし")
-            last_sent = max(int(data["timestamp"]) for data in past_res.json()["data"])
-            if time.time() - last_sent > 24 * 60 * 60 + 300:
+            last_sent = self.history.last_sent()
+            if last_sent is None or time.time() - last_sent > 24 * 60 * 60 + 300:
                 logger.info("繰り返しのメッセージはなし")
                 return
 
@@ -110,30 +380,118 @@ class DailyProjects(commands.Cog):
         logger.debug(f"選択肢: {[str(x) for x in projects_candidate]}")
         logger.debug(f"重み: {projects_weight}")
 
-        choiced_project = random.choices(projects_candidate, k=1, weights=projects_weight)[0]
+        choiced_project = await self._choose_project(projects_candidate, projects_weight)
+        if choiced_project is None:
+            logger.info("審査状況を確認した結果、対象作品なし")
+            return
         logger.info(f"選ばれた作品: {choiced_project.title}")
 
         text = f"## 今日の作品\nhttps://scratch.mit.edu/projects/{choiced_project.id}/"
         if mention:
             text += "\n|| <@&1324929451175313438> ||"
-        scratch_info = ScratchInfo(type="projects", id=choiced_project.id)
-        await scratch_info._get_info()
+        embed = pool.embeds.get(choiced_project.id)
+        rendered_at = pool.rendered_at.get(choiced_project.id, 0)
+        if embed is None or time.time() - rendered_at >= self.embed_max_age:
+            embed = await self._render_embed(choiced_project.id) or embed
+        if embed is None:
+            scratch_info = ScratchInfo(type="projects", id=choiced_project.id)
+            await scratch_info._get_info()
+            embed = scratch_info.get_embed(can_delete=False)
 
         channel = self.bot.get_channel(int(self.channel_id))
-        message = await channel.send(content=text, embed=scratch_info.get_embed(can_delete=False))
-        await message.add_reaction(self.bot.get_emoji(1324552402250236005))  # :scratch_love:
-        await message.add_reaction(self.bot.get_emoji(1324552400022798416))  # :scratch_favorite:
+        queue: ActionQueue = self.bot.action_queue
+        message = await queue.run(channel_bucket(channel.id), lambda: channel.send(content=text, embed=embed))
         logger.debug(f"メッセージを送信しました: {message.id}")
 
+        # リアクションは順番に、スレッド作成は別のバケットで並行して行う
+        reactions = queue.flow()
+        reactions.submit(reaction_bucket(channel.id), lambda: message.add_reaction(self.bot.get_emoji(1324552402250236005)))  # :scratch_love:
+        reactions.submit(reaction_bucket(channel.id), lambda: message.add_reaction(self.bot.get_emoji(1324552400022798416)))  # :scratch_favorite:
+
         TODAY = datetime.datetime.now(JST).strftime("%Y/%m/%d")
-        await message.create_thread(name=TODAY+" 作品", reason=f"今日の作品(自動作成) {TODAY}")
+        thread = queue.submit(channel_bucket(channel.id), lambda: message.create_thread(name=TODAY+" 作品", reason=f"今日の作品(自動作成) {TODAY}"))
+        await reactions.wait()
+        await thread
         logger.debug("スレッドを作成しました")
 
-        requests.post(self.api_url, json={
-            "id": choiced_project.id,
-            "title": choiced_project.title,
-            "pass": self.api_pass
-        })
+        # APIへの登録はoutbox経由で後から送る
+        self.history.record(choiced_project.id, choiced_project.title)
+        self.history.enqueue({"id": choiced_project.id, "title": choiced_project.title})
+        self._flush_task = asyncio.create_task(self._flush_outbox())
+        self._flush_task.add_done_callback(self._log_flush_error)
+
+    @staticmethod
+    def _log_flush_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"履歴の送信中にエラーが発生しました {task.exception()!r}")
+
+    async def _live_moderation_status(self, project_id: int) -> Optional[str]:
+        """作品の現在の審査状況を確認し、インデックスにも反映します
+
+        Returns:
+            Optional[str]: 審査状況。確認できなかった場合はNone
+        """
+        await self.scan_rate.acquire()
+        try:
+            project_remixtree = await scapi.get_remixtree(project_id, ClientSession=scratch_session.get())
+        except (scapi.exception.HTTPError, scapi.exception.ObjectFetchError, aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            logger.warning(f"掲載前の審査状況の確認に失敗しました {project_id} {e!r}")
+            return None
+        status = project_remixtree.moderation_status
+        self.project_index.update_statuses(self.studio_id, [(project_id, status)])
+        return status
+
+    async def _choose_project(self, candidates: list[IndexedProject], weights: list[int]) -> Optional[IndexedProject]:
+        """重みに従って作品を選びます
+
+        インデックスの審査状況は最大でrevalidate_age秒前のものなので、選んだ作品をその場で確認し直し、
+        notsafeになっていた場合は除外して選び直します。確認できなかった場合はインデックスの状況を信用します。
+
+        Returns:
+            Optional[IndexedProject]: 選んだ作品。すべて除外された場合はNone
+        """
+        candidates = list(candidates)
+        weights = list(weights)
+        while candidates:
+            index = random.choices(range(len(candidates)), k=1, weights=weights)[0]
+            project = candidates[index]
+            if await self._live_moderation_status(project.id) != "notsafe":
+                return project
+
+            logger.info(f"掲載前の確認でnotsafeになっていたため除外します: {project}")
+            del candidates[index]
+            del weights[index]
+            # 同じプールから再び選ばれないようにする
+            if self.pool is not None and project in self.pool.candidates:
+                position = self.pool.candidates.index(project)
+                del self.pool.candidates[position]
+                del self.pool.weights[position]
+        return None
+
+    async def _flush_outbox(self) -> None:
+        """outboxに溜まった履歴をAPIに送信します。失敗したものは間隔をあけて再送します。"""
+        async with self._flush_lock:
+            for entry in self.history.due_outbox():
+                try:
+                    res = await self.bot.http_client.post(self.api_url, json=entry.payload | {"pass": self.api_pass})
+                    if res.status >= 400:
+                        raise ConnectionError(f"コード: {res.status}")
+                except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                    retry_after = min(60 * 2 ** entry.attempts, 60 * 60)
+                    self.history.mark_failed(entry.id, str(e), retry_after)
+                    logger.warning(f"履歴の登録に失敗しました {entry.payload['id']} ({retry_after}秒後に再送) {e}")
+                    continue
+
+                self.history.mark_sent(entry.id)
+                logger.debug(f"履歴を登録しました {entry.payload['id']}")
+
+    @tasks.loop(minutes=1)
+    async def outbox_loop(self):
+        # 例外で止まると以降の履歴が送信されなくなるため、ここで受け止める
+        try:
+            await self._flush_outbox()
+        except Exception as e:
+            logger.error(f"履歴の送信中にエラーが発生しました {e!r}")
 
     @app_commands.command(name="admin_decide_daily_project", description="手動で今日の作品を選出します。")
     @limit_command(only_admin=True, only_cloudserver=True)
@@ -142,9 +500,27 @@ class DailyProjects(commands.Cog):
         await self.decide_daily_project(mention=False)
         await interaction.followup.send("選出が完了しました", ephemeral=True)
 
+    @app_commands.command(name="admin_rebuild_project_index", description="今日の作品のインデックスを作り直します。")
+    @limit_command(only_admin=True, only_cloudserver=True)
+    async def rebuild_index_command(self, interaction: Interaction):
+        await interaction.response.defer(ephemeral=True)
+        timings: dict[str, float] = {}
+        try:
+            # 候補プールの更新と同時にインデックスを書き換えないようにする
+            async with self._pool_lock:
+                studio: scapi.Studio = await scapi.get_studio(self.studio_id, ClientSession=scratch_session.get())
+                await self.refresh_index(studio, timings, full=True)
+        except (scapi.exception.HTTPError, scapi.exception.ObjectFetchError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"インデックスの作り直しに失敗しました {e!r}")
+            await interaction.followup.send("インデックスの作り直しに失敗しました。時間をおいてもう一度お試しください。", ephemeral=True)
+            return
+        await interaction.followup.send(f"インデックスを作り直しました ({self.project_index.count(self.studio_id)}件, {timings['scan']:.1f}秒)", ephemeral=True)
+
     @commands.Cog.listener()
     async def on_ready(self):
-        pass
+        last_scan = self.project_index.last_scan(self.studio_id)
+        scan_status = f"{(time.time() - last_scan) / 60:.0f}分前" if last_scan else "なし"
+        logger.info(f"今日の作品 候補プール: {self.pool_status()} / 最終スキャン: {scan_status} / 未送信の履歴: {self.history.outbox_size()}件")
         # await self.bot.tree.sync()
 
 
@@ -1,17 +1,29 @@
 from __future__ import annotations  # 型アノテーション時の参照エラー回避
 import os
+import re
 import base64
+import asyncio
+import time
 from typing import Literal, Optional
 from logging import getLogger, StreamHandler, DEBUG
-from dataclasses import dataclass
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
-import requests
+import aiohttp
 
 from discordbot.templates import EmojiTemplates
-from ..templates import limit_command, _command_is_cs_admin
+from discordbot.http_client import HttpClient, HttpResponse
+from discordbot.pending_auth import create_pending_auth_store, PendingAuthBusyError, WaitingData
+from discordbot.cache import TTLCache
+from discordbot.action_queue import channel_bucket, member_bucket
+from discordbot.resilience import CircuitOpenError, ResilientCaller
+from discordbot.lazy_import import lazy_import
+from discordbot.scratch_session import scratch_session
+from ..templates import limit_command, role_index, _command_is_cs_admin
+
+# 起動時の読み込みを軽くするため、最初に使うときに読み込む
+scapi = lazy_import("scapi")
 
 
 logger = getLogger(__name__)
@@ -22,19 +34,22 @@ logger.addHandler(handler)
 logger.propagate = False
 
 
-@dataclass
-class WaitingData:
-    public_code: str
-    private_code: str
-    method: Literal["cloud", "comment", "profile-comment"]
-    username: Optional[str] = None
-
-
 class ScratchAuth:
-    def __init__(self, *, api: str = "https://auth-api.itinerary.eu.org", redirect: str = "https://www.takechi.cloud/"):
+    error_embed = discord.Embed(title="ユーザー認証", description="エラーが発生しました。\nお手数ですが、最初から認証をやり直してください。", color=0xb3b3b3)
+    busy_embed = discord.Embed(title="ユーザー認証", description="混み合っています。\n少し待ってから、もう一度ボタンを押してください。", color=0xb3b3b3)
+
+    def __init__(self, *, api: Optional[str] = None, redirect: str = "https://www.takechi.cloud/",
+                 http_client: Optional[HttpClient] = None):
         """Scratch認証を行います。
         環境変数に'SCRATCH_AUTH_PROJECT_ID'を設定してください。
 
+        APIとの通信にはタイムアウトとサーキットブレーカーを適用し、トークンの発行は失敗時に再試行します。
+        'SCRATCH_AUTH_API_TIMEOUT'でタイムアウト(秒)を、'SCRATCH_AUTH_API_HEDGE_AFTER'でトークンの発行を並行して送るまでの秒数を指定できます。
+
+        Args:
+            api (str, optional): APIのURL。省略時は環境変数'SCRATCH_AUTH_API_URL'、またはauth-api.itinerary.eu.org
+            http_client (HttpClient, optional): APIとの通信に使うクライアント。省略時はinit_with_botでBotのものを利用します。
+
         Raises:
             ValueError: 環境変数が適切に設定されていない場合
         """
@@ -44,12 +59,20 @@ class ScratchAuth:
         if not self.auth_project_id:
             raise ValueError("Scratch認証用のプロジェクトを環境変数に指定してください。")
 
-        self.auth_API = api
+        self.auth_API = (api or os.environ.get("SCRATCH_AUTH_API_URL") or "https://auth-api.itinerary.eu.org").rstrip("/")
+        hedge_after = os.environ.get("SCRATCH_AUTH_API_HEDGE_AFTER")
+        self.api = ResilientCaller(
+            "auth_api",
+            timeout=float(os.environ.get("SCRATCH_AUTH_API_TIMEOUT", 5.0)),
+            hedge_after=float(hedge_after) if hedge_after else None,
+        )
         self.auth_redirect = redirect
-        self.waitings: dict[str, WaitingData] = {}
+        self.http_client: Optional[HttpClient] = http_client
+        self.waitings = create_pending_auth_store()
+        self.poller: Optional[AuthPoller] = None
         self.cs_guild: Optional[discord.Guild] = None
 
-        self.error_embed = discord.Embed(title="ユーザー認証", description="エラーが発生しました。\nお手数ですが、最初から認証をやり直してください。", color=0xb3b3b3)
+        self._choose_method_layout: Optional[ChooseMethodView] = None
 
     def init_with_bot(self, bot: commands.Bot):
         """Botのインスタンスを利用した初期化
@@ -59,13 +82,60 @@ class ScratchAuth:
         """
 
         self.bot = bot
+        if self.http_client is None:
+            self.http_client = bot.http_client
 
+        # 選択肢と「入力しました」ボタンはcustom_idで振り分けるため、登録は1つだけ
         bot.add_view(ChooseMethodView(self, EmojiTemplates(bot)))
-        bot.add_view(WaitingVerifyView(self, 0))
+        bot.add_dynamic_items(VerifyTokenButton)
 
         self.cs_guild = self.bot.get_guild(int(os.environ.get("DISCORD_CS_SERVERID")))
 
-    def get_tokens(self, method: Literal["cloud", "comment", "profile-comment"], discord_id: int, username: str = None) -> WaitingData:
+    def choose_method_layout(self) -> ChooseMethodView:
+        """送信用の認証方法の選択肢を返します
+
+        絵文字の解決は一度だけ行い、同じレイアウトを使い回します。押された選択肢はinit_with_botで登録したViewが処理します。
+        """
+        if self._choose_method_layout is not None:
+            return self._choose_method_layout
+
+        emoji_templates = EmojiTemplates(self.bot)
+        layout = ChooseMethodView(self, emoji_templates)
+        layout.stop()
+
+        # 絵文字のキャッシュがまだない場合は次回に作り直す
+        if all([emoji_templates.auth_cloud, emoji_templates.auth_comment, emoji_templates.auth_profile_comment]):
+            self._choose_method_layout = layout
+        return layout
+
+    def is_verified(self, discord_id: int) -> bool:
+        """公式サーバーでCSuserロールを持っているか"""
+        if not self.cs_guild:
+            return False
+        member = self.cs_guild.get_member(discord_id)
+        return member is not None and role_index.member_has_role(member, "CSuser")
+
+    async def _request_api(self, path: str, params: Optional[dict] = None, *, idempotent: bool = False) -> HttpResponse:
+        """APIにリクエストを送信します
+
+        Args:
+            idempotent (bool, optional): 再試行・ヘッジしてよいリクエストか
+
+        Raises:
+            ConnectionError: 通信に失敗した場合や、サーキットブレーカーが開いている場合
+        """
+        if self.http_client is None:
+            raise RuntimeError("HTTPクライアントが設定されていません")
+
+        async def request() -> HttpResponse:
+            res = await self.http_client.get(f"{self.auth_API}{path}", params=params, timeout=self.api.timeout)
+            if res.status >= 500:
+                raise ConnectionError(f"APIでエラーが発生しました コード: {res.status}")
+            return res
+
+        return await self.api.call(request, idempotent=idempotent)
+
+    async def get_tokens(self, method: Literal["cloud", "comment", "profile-comment"], discord_id: int, username: str = None) -> WaitingData:
         """認証用のトークンを取得します
 
         Args:
@@ -90,12 +160,13 @@ class ScratchAuth:
             params["username"] = username
 
         logger.debug(f"APIリクエスト: {params}")
-        res = requests.get(f"{self.auth_API}/auth/getTokens/", params=params)
+        # 発行し直しても前のトークンを使わないだけなので、再試行してよい
+        res = await self._request_api("/auth/getTokens/", params=params, idempotent=True)
         # {'publicCode': 'abcabc', 'privateCode': 'abcabcabcabc', 'redirectLocation': 'https://www.takechi.cloud/', 'method': 'comment', 'authProject': '1071161378'}
-        logger.debug(f"APIレスポンス: {res.json()}")
+        logger.debug(f"APIレスポンス: {res.text}")
 
-        if res.status_code != 200:
-            raise ConnectionError(f"APIの取得に失敗しました コード: {res.status_code}")
+        if res.status != 200:
+            raise ConnectionError(f"APIの取得に失敗しました コード: {res.status}")
 
         res_json = res.json()
 
@@ -103,7 +174,7 @@ class ScratchAuth:
         if method == "profile-comment":
             waiting.username = username
 
-        self.waitings[discord_id] = waiting
+        self.waitings.put(discord_id, waiting)
 
         return waiting
 
@@ -118,20 +189,33 @@ class ScratchAuth:
             ConnectionError: APIとの通信でエラーが発生した場合
 
         Returns:
-            Any: APIのレスポンス
+            Optional[bool]: 認証できたか。認証待ちが見つからない(期限切れ、または他のプロセスが処理済み)場合はNone
         """
 
+        # 通信できない間は、認証待ちを消さずにすぐ失敗させる
+        if not self.api.breaker.available:
+            raise CircuitOpenError("認証APIは一時的に利用できません")
+
         # ScratchAuthも1回で待機リストから消されるためここで削除
-        discord_id = list({k: v for k, v in self.waitings.items() if v.private_code == private_code}.items())[0][0]
-        self.waitings.pop(discord_id)
+        found = self.waitings.pop_by_private_code(private_code)
+        if found is None:
+            logger.info("認証データが見つからないか、有効期限が切れています")
+            return None
+        discord_id, waiting = found
 
         logger.debug(f"プライベートコード: {private_code}")
-        res = requests.get(f"{self.auth_API}/auth/verifyToken/{private_code}")
-        logger.debug(f"APIレスポンス: {res.text}, コード: {res.status_code}, タイプ: {res.headers['content-type']}")
+        # 検証するとトークンが消費されるため、再試行しない
+        try:
+            res = await self._request_api(f"/auth/verifyToken/{private_code}")
+        except CircuitOpenError:
+            # 送信していないためトークンは消費されていない。認証待ちを戻す
+            self.waitings.put(discord_id, waiting)
+            raise
+        logger.debug(f"APIレスポンス: {res.text}, コード: {res.status}, タイプ: {res.headers.get('content-type')}")
 
         # 失敗だと403になるが、JSONは取得できる
-        if not res.headers["content-type"].lower().startswith("application/json"):
-            raise ConnectionError(f"APIの取得に失敗しました コード: {res.status_code}")
+        if not res.headers.get("content-type", "").lower().startswith("application/json"):
+            raise ConnectionError(f"APIの取得に失敗しました コード: {res.status}")
 
         res_json = res.json()
         # {"valid":false,"username":null,"redirect":null}
@@ -144,15 +228,29 @@ class ScratchAuth:
             logger.error("認証元が異なります")
             return False
 
+        if not self.cs_guild:
+            self.cs_guild = self.bot.get_guild(int(os.environ.get("DISCORD_CS_SERVERID")))
         if not self.cs_guild:
             raise RuntimeError("Botによる初期化がされていなかったため、ロールを付与できません")
 
         member = self.cs_guild.get_member(discord_id)
-        await member.add_roles(discord.utils.get(self.cs_guild.roles, name="CSuser"), reason="ユーザー認証による自動付与")
-
-        await self.cs_guild.get_channel(int(os.environ.get("DISCORD_CS_CHANNELID"))).send(
-            f'ユーザー認証が完了しました。臨時で記録しています。\nScratch: {res_json["username"]}\nDiscord: {member.id}'
-            )
+        if member is None:
+            # サーバーを抜けた場合など。トークンは消費済みのため、認証自体は成功として扱う
+            logger.warning(f'メンバーが見つからないため、ロールを付与できません Scratch: {res_json["username"]} Discord: {discord_id}')
+            return True
+
+        flow = self.bot.action_queue.flow()
+        add_role = flow.submit(member_bucket(self.cs_guild.id),
+                               lambda: member.add_roles(role_index.get_role(self.cs_guild, "CSuser"), reason="ユーザー認証による自動付与"))
+        log_channel = self.cs_guild.get_channel(int(os.environ.get("DISCORD_CS_CHANNELID") or 0))
+        if log_channel is not None:
+            # 記録はロールの付与後に送信されるが、完了は待たない
+            flow.submit(channel_bucket(log_channel.id), lambda: log_channel.send(
+                f'ユーザー認証が完了しました。臨時で記録しています。\nScratch: {res_json["username"]}\nDiscord: {member.id}'
+                ))
+        else:
+            logger.warning("記録用のチャンネルが見つからないため、認証の記録を送信しません")
+        await add_role
 
         logger.info(f'ユーザー認証完了 Scratch: {res_json["username"]} Discord: {member.id}')
 
@@ -168,34 +266,184 @@ class ScratchAuth:
             discord.Embed: Discordに送信する用の埋め込み
         """
 
-        if discord_id not in self.waitings.keys():
+        waiting = self.waitings.get(discord_id)
+        if waiting is None:
             logger.error(f"認証データが見つかりません DiscordID: {discord_id}")
             return self.error_embed, None, None
 
         embed = discord.Embed(title="ユーザー認証", color=0x4459fe)
         view = None
 
-        method = self.waitings[discord_id].method
-        public_code = self.waitings[discord_id].public_code
+        method = waiting.method
+        public_code = waiting.public_code
 
         if method == "profile-comment":
-            username = self.waitings[discord_id].username
+            username = waiting.username
             if not username:
                 logger.error(f"ユーザー名が見つかりません DiscordID: {discord_id}")
                 return self.error_embed, None, None
 
             embed.description = f"準備ができました！以下のコードを自分のプロフィールにコメントして、下の「入力しました」ボタンを押してください。\n```\n{public_code}\n```"
-            view = WaitingVerifyView(self, discord_id, f"https://scratch.mit.edu/users/{username}/#comments")
+            view = WaitingVerifyView(discord_id, f"https://scratch.mit.edu/users/{username}/#comments")
         else:
             if method == "cloud":
                 embed.description = f"準備ができました！\n以下のコードを[入力用ページ](https://scratch.mit.edu/projects/{self.auth_project_id}/)で入力して、下の「入力しました」ボタンを押してください。\n```\n{public_code}\n```"
             else:
                 embed.description = f"準備ができました！\n以下のコードを[入力用ページ](https://scratch.mit.edu/projects/{self.auth_project_id}/)でコメントして、下の「入力しました」ボタンを押してください。\n```\n{public_code}\n```"
-            view = WaitingVerifyView(self, discord_id, f"https://scratch.mit.edu/projects/{self.auth_project_id}/")
+            view = WaitingVerifyView(discord_id, f"https://scratch.mit.edu/projects/{self.auth_project_id}/")
 
         return embed, view, public_code
 
 
+class AuthPoller:
+    """認証待ちをまとめて確認し、ボタンを押さなくても認証を完了させる
+
+    ScratchAuthのverifyTokenは1回で待機リストから消えるため、先に公開されているクラウド変数の履歴や
+    コメントに公開コードが現れたかを確認し、見つかったものだけverifyTokenを呼び出します。
+    """
+
+    def __init__(self, scratch_auth: ScratchAuth):
+        self.scratch_auth = scratch_auth
+        self._next_check: dict[int, float] = {}
+        self._in_progress: set[int] = set()
+        # 同じ時間帯の確認では取得結果を共有する
+        self._evidence = TTLCache(maxsize=256, ttl=3.0, stale_ttl=0)
+        self._project_author: Optional[str] = None
+        # 公開コードの確認1回あたりのタイムアウト(秒)
+        self.fetch_timeout = 10.0
+
+    @staticmethod
+    def interval(age: float) -> float:
+        """作成からの経過時間に応じた確認間隔(秒)"""
+        if age < 2 * 60:
+            return 5
+        if age < 10 * 60:
+            return 15
+        return 60
+
+    def _evidence_key(self, waiting: WaitingData) -> tuple[str, str]:
+        if waiting.method == "profile-comment":
+            return "profile-comment", waiting.username.lower()
+        return waiting.method, self.scratch_auth.auth_project_id
+
+    async def _fetch_evidence(self, key: tuple[str, str]) -> str:
+        # Scratchへの問い合わせは、Botで共有するセッションで接続を使い回す
+        client_session = scratch_session.get()
+        method, target = key
+        if method == "cloud":
+            res = await client_session.get("https://clouddata.scratch.mit.edu/logs", params={"projectid": target, "limit": "100", "offset": "0"})
+            return "\n".join(str(log.get("value")) for log in res.json())
+        if method == "comment":
+            if self._project_author is None:
+                res = await client_session.get(f"https://api.scratch.mit.edu/projects/{target}")
+                self._project_author = res.json()["author"]["username"]
+            res = await client_session.get(f"https://api.scratch.mit.edu/users/{self._project_author}/projects/{target}/comments",
+                                           params={"limit": "40", "offset": "0"})
+            return "\n".join(str(comment.get("content")) for comment in res.json())
+        res = await client_session.get(f"https://scratch.mit.edu/site-api/comments/user/{target}/", params={"page": "1"})
+        return res.text
+
+    async def _has_evidence(self, waiting: WaitingData) -> bool:
+        key = self._evidence_key(waiting)
+        try:
+            evidence = await self._evidence.get_or_fetch(key, lambda: asyncio.wait_for(self._fetch_evidence(key), self.fetch_timeout))
+        except (scapi.exception.HTTPError, aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            logger.warning(f"認証状況の確認に失敗しました {key}: {e}")
+            return False
+        return waiting.public_code in evidence
+
+    async def _try_complete(self, discord_id: int, waiting: WaitingData) -> Optional[bool]:
+        """公開コードが見つかった場合だけ認証します
+
+        Raises:
+            CircuitOpenError: 認証APIが一時的に利用できない場合。認証待ちは残っている
+            PendingAuthBusyError: 認証待ちのデータベースが使用中の場合。認証待ちは残っている
+            ConnectionError: 認証APIとの通信に失敗した場合。認証待ちは消えている
+
+        Returns:
+            Optional[bool]: 認証結果。まだ公開コードが見つからない場合はNone
+        """
+        if discord_id in self._in_progress or not await self._has_evidence(waiting):
+            return None
+
+        self._in_progress.add(discord_id)
+        try:
+            return await self.scratch_auth.verify_token(waiting.private_code)
+        finally:
+            self._in_progress.discard(discord_id)
+            self._next_check.pop(discord_id, None)
+
+    async def _notify(self, discord_id: int, result: Optional[bool]) -> None:
+        """認証結果をDMで知らせます。Noneの場合は通信の失敗で認証を続けられなかったことを知らせます"""
+        user = self.scratch_auth.bot.get_user(discord_id)
+        if user is None:
+            return
+        if result is None:
+            embed = ScratchAuth.error_embed
+        elif result:
+            embed = discord.Embed(title="ユーザー認証", description="認証が完了しました！", color=0x43b581)
+        else:
+            embed = discord.Embed(
+                title="ユーザー認証",
+                description="認証に失敗しました。お手数ですが、最初からやり直してください。\n何回やっても失敗する場合は、管理者にお問い合わせください。",
+                color=0xf6a408
+            )
+        try:
+            await user.send(embed=embed)
+        except discord.HTTPException as e:
+            logger.warning(f"認証結果を送信できませんでした DiscordID: {discord_id} {e}")
+
+    async def poll(self) -> None:
+        """確認時刻を迎えた認証待ちをまとめて確認します"""
+        now = time.time()
+        due: list[tuple[int, WaitingData]] = []
+        pending_ids = set()
+        for discord_id, waiting in self.scratch_auth.waitings:
+            pending_ids.add(discord_id)
+            if self._next_check.get(discord_id, 0) <= now:
+                due.append((discord_id, waiting))
+
+        for discord_id in self._next_check.keys() - pending_ids:
+            del self._next_check[discord_id]
+
+        if not due:
+            return
+
+        results = await asyncio.gather(*[self._try_complete(discord_id, waiting) for discord_id, waiting in due], return_exceptions=True)
+        for (discord_id, waiting), result in zip(due, results):
+            if isinstance(result, (CircuitOpenError, PendingAuthBusyError)):
+                # 認証待ちは消えていないため、次の確認で再び試す
+                logger.info(f"認証を進められないため、後で確認します DiscordID: {discord_id} {result}")
+                self._next_check[discord_id] = now + self.interval(now - waiting.created_at)
+            elif isinstance(result, ConnectionError):
+                # verifyTokenを送った後の失敗は、トークンが消費された可能性があり続けられない
+                logger.warning(f"認証APIとの通信に失敗しました DiscordID: {discord_id} {result}")
+                await self._notify(discord_id, None)
+            elif isinstance(result, BaseException):
+                logger.error(f"認証の自動確認中にエラーが発生しました DiscordID: {discord_id} {result!r}")
+            elif result is None:
+                self._next_check[discord_id] = now + self.interval(now - waiting.created_at)
+            else:
+                logger.info(f"自動確認で認証処理を行いました DiscordID: {discord_id} 結果: {result}")
+                await self._notify(discord_id, result)
+
+    async def check_now(self, discord_id: int) -> Optional[bool]:
+        """ボタンが押されたときに、その人の分だけすぐに確認します
+
+        Raises:
+            CircuitOpenError: 認証APIが一時的に利用できない場合
+            PendingAuthBusyError: 認証待ちのデータベースが使用中の場合
+            ConnectionError: 認証APIとの通信に失敗した場合
+        """
+        waiting = self.scratch_auth.waitings.get(discord_id)
+        if waiting is None:
+            return None
+        # 公開コードが見つかっても認証できないため、確認を待たせずにすぐ失敗させる
+        if not self.scratch_auth.api.breaker.available:
+            raise CircuitOpenError("認証APIは一時的に利用できません")
+        return await self._try_complete(discord_id, waiting)
+
+
 class csAuthStartView(discord.ui.View):
     def __init__(self, scratch_auth: ScratchAuth, bot: commands.Bot, timeout=None):
         self.scratch_auth = scratch_auth
@@ -204,12 +452,12 @@ class csAuthStartView(discord.ui.View):
 
     @discord.ui.button(label="はじめる", custom_id="startauth", style=discord.ButtonStyle.primary)
     async def start(self, interaction: discord.Interaction, button: discord.Button) -> None:
-        if discord.utils.get(interaction.user.roles, name="CSuser") is not None:
+        if role_index.member_has_role(interaction.user, "CSuser"):
             embed = discord.Embed(title="ユーザー認証", description="あなたはすでに認証が完了しているようです。", color=0x43b581)
             await interaction.response.send_message(embed=embed, ephemeral=True)
         else:
             await interaction.response.send_message(embed=discord.Embed(title="ユーザー認証", description="認証方法を選択してください！", color=0x4459fe),
-                                                    view=ChooseMethodView(self.scratch_auth, EmojiTemplates(self.bot)), ephemeral=True)
+                                                    view=self.scratch_auth.choose_method_layout(), ephemeral=True)
 
 
 class ChooseMethodView(discord.ui.View):
@@ -234,14 +482,20 @@ class ChooseMethodView(discord.ui.View):
         self.add_item(self.select)
 
     async def get_token(self, interaction: discord.Interaction) -> None:
-        method = self.select.values[0]
+        # 同じインスタンスで全員の選択を受けるため、選択値はinteractionから取る
+        method = interaction.data["values"][0]
         if method == "profile-comment":
             await interaction.response.send_modal(UsernameModal(self.scratch_auth))
             return
 
         await interaction.response.defer(ephemeral=True)
 
-        self.scratch_auth.get_tokens(method, interaction.user.id)
+        try:
+            await self.scratch_auth.get_tokens(method, interaction.user.id)
+        except ConnectionError as e:
+            logger.warning(f"トークンの取得に失敗しました {e}")
+            await interaction.followup.send(embed=ScratchAuth.error_embed, ephemeral=True)
+            return
         embed, view, public_code = self.scratch_auth.waiting_embed(interaction.user.id)
         if view and public_code:
             await interaction.user.send(f"認証コード: {public_code}", embed=embed, view=view)
@@ -252,7 +506,8 @@ class ChooseMethodView(discord.ui.View):
 
 class UsernameModal(discord.ui.Modal):
     def __init__(self, scratch_auth: ScratchAuth) -> None:
-        super().__init__(title="ユーザー認証")
+        # 閉じられたモーダルもView storeに残るため、認証待ちの有効期間で破棄する
+        super().__init__(title="ユーザー認証", timeout=scratch_auth.waitings.ttl)
 
         self.scratch_auth = scratch_auth
         self.username = discord.ui.TextInput(label="Scratchのユーザー名", style=discord.TextStyle.short, placeholder="scratchcat", min_length=3, max_length=20)
@@ -261,7 +516,12 @@ class UsernameModal(discord.ui.Modal):
     async def on_submit(self, interaction: discord.Interaction) -> None:
         await interaction.response.defer(ephemeral=True)
 
-        self.scratch_auth.get_tokens("profile-comment", interaction.user.id, self.username.value)
+        try:
+            await self.scratch_auth.get_tokens("profile-comment", interaction.user.id, self.username.value)
+        except ConnectionError as e:
+            logger.warning(f"トークンの取得に失敗しました {e}")
+            await interaction.followup.send(embed=ScratchAuth.error_embed, ephemeral=True)
+            return
         embed, view, public_code = self.scratch_auth.waiting_embed(interaction.user.id)
         if view and public_code:
             await interaction.user.send(f"認証コード: {public_code}", embed=embed, view=view)
@@ -271,19 +531,52 @@ class UsernameModal(discord.ui.Modal):
 
 
 class WaitingVerifyView(discord.ui.View):
-    """認証コードを表示しつつ、入力を待つView"""
+    """認証コードを表示しつつ、入力を待つView
 
-    def __init__(self, scratch_auth: ScratchAuth, discord_id: int, link_url: Optional[str] = None, timeout: Optional[int] = None):
-        super().__init__(timeout=timeout)
-        self.scratch_auth = scratch_auth
-        self.discord_id = discord_id
+    送信用のレイアウトで、View storeには登録しません。ボタンはVerifyTokenButtonが処理します。
+    """
+
+    def __init__(self, discord_id: int, link_url: Optional[str] = None):
+        super().__init__(timeout=None)
+        self.add_item(VerifyTokenButton(discord_id))
 
         if link_url:
             self.add_item(discord.ui.Button(label="入力用ページへ", url=link_url, style=discord.ButtonStyle.link))
 
-    @discord.ui.button(label="入力しました", custom_id="verify_token", style=discord.ButtonStyle.primary)
-    async def start(self, interaction: discord.Interaction, button: discord.Button) -> None:
-        if self.discord_id not in self.scratch_auth.waitings.keys():
+        # 送信時にView storeへ保持されないよう終了済みにする
+        self.stop()
+
+
+class VerifyTokenButton(discord.ui.DynamicItem[discord.ui.Button], template=r"verify_token(?::(?P<discord_id>[0-9]+))?"):
+    """「入力しました」ボタン
+
+    custom_idに認証するユーザーのDiscordIDを含めるため、Viewを保持しなくても再起動後も押せます。
+    """
+
+    def __init__(self, discord_id: int, scratch_auth: Optional[ScratchAuth] = None):
+        super().__init__(discord.ui.Button(label="入力しました", custom_id=f"verify_token:{discord_id}", style=discord.ButtonStyle.primary))
+        self.discord_id = discord_id
+        self.scratch_auth = scratch_auth
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str], /):
+        cog: Optional[ScratchAuthCog] = interaction.client.get_cog("ScratchAuthCog")
+        # 以前の形式(IDなし)のボタンは押した本人の認証として扱う
+        discord_id = int(match["discord_id"]) if match["discord_id"] else interaction.user.id
+        return cls(discord_id, cog.scratch_auth if cog else None)
+
+    async def callback(self, interaction: discord.Interaction) -> None:
+        if self.scratch_auth is None:
+            await interaction.response.send_message(embed=ScratchAuth.error_embed)
+            return
+
+        waiting = self.scratch_auth.waitings.get(self.discord_id)
+        if waiting is None and self.scratch_auth.is_verified(self.discord_id):
+            embed = discord.Embed(title="ユーザー認証", description="認証が完了しました！", color=0x43b581)
+            await interaction.response.send_message(embed=embed)
+            return
+
+        if waiting is None:
             logger.info(f"認証データなし DiscordID: {self.discord_id}")
             embed = discord.Embed(title="ユーザー認証", description="認証の有効期限が切れました。お手数ですが、最初からやり直してください。", color=0xf6a408)
             await interaction.response.send_message(embed=embed)
@@ -291,8 +584,38 @@ class WaitingVerifyView(discord.ui.View):
 
         await interaction.response.defer()
 
-        waiting = self.scratch_auth.waitings[self.discord_id]
-        res = await self.scratch_auth.verify_token(waiting.private_code)
+        if self.scratch_auth.poller:
+            # 自動確認が有効な場合は、公開コードが見つかるまで認証を消費しない
+            try:
+                res = await self.scratch_auth.poller.check_now(self.discord_id)
+            except PendingAuthBusyError as e:
+                logger.info(f"認証待ちのデータベースが使用中です {e}")
+                await interaction.followup.send(embed=ScratchAuth.busy_embed)
+                return
+            except ConnectionError as e:
+                logger.warning(f"認証APIとの通信に失敗しました {e}")
+                await interaction.followup.send(embed=ScratchAuth.error_embed)
+                return
+            if res is None:
+                embed = discord.Embed(title="ユーザー認証", description="まだコードを確認できていません。\n入力が反映されると自動で認証が完了します。", color=0x4459fe)
+                await interaction.followup.send(embed=embed)
+                return
+        else:
+            try:
+                res = await self.scratch_auth.verify_token(waiting.private_code)
+            except PendingAuthBusyError as e:
+                logger.info(f"認証待ちのデータベースが使用中です {e}")
+                await interaction.followup.send(embed=ScratchAuth.busy_embed)
+                return
+            except ConnectionError as e:
+                logger.warning(f"認証APIとの通信に失敗しました {e}")
+                await interaction.followup.send(embed=ScratchAuth.error_embed)
+                return
+
+        # 他のプロセスが先に処理した場合
+        if res is None and self.scratch_auth.is_verified(self.discord_id):
+            res = True
+
         if res:
             embed = discord.Embed(title="ユーザー認証", description="認証が完了しました！", color=0x43b581)
             await interaction.followup.send(embed=embed)
@@ -312,25 +635,56 @@ class ScratchAuthCog(commands.Cog):
         self.bot = bot
         self.scratch_auth = ScratchAuth()
         self.scratch_auth.init_with_bot(bot)
+        self.sweep_waitings.start()
+
+        # 環境変数'SCRATCH_AUTH_AUTO_VERIFY'が設定されていれば、ボタンを押さなくても自動で認証する
+        if os.environ.get("SCRATCH_AUTH_AUTO_VERIFY"):
+            self.scratch_auth.poller = AuthPoller(self.scratch_auth)
+            self.poll_waitings.start()
 
         # self.bot.tree.add_command(self.auth_command)
 
+    def cog_unload(self):
+        self.bot.remove_dynamic_items(VerifyTokenButton)
+        self.sweep_waitings.cancel()
+        self.poll_waitings.cancel()
+        self.scratch_auth.waitings.close()
+
+    @tasks.loop(seconds=5)
+    async def poll_waitings(self):
+        try:
+            await self.scratch_auth.poller.poll()
+        except Exception as e:
+            logger.error(f"認証の自動確認中にエラーが発生しました {e}")
+
+    @tasks.loop(minutes=1)
+    async def sweep_waitings(self):
+        try:
+            removed = self.scratch_auth.waitings.sweep()
+        except PendingAuthBusyError:
+            # 次の実行で削除する
+            return
+        if removed:
+            logger.debug(f"期限切れの認証データを削除しました {removed}件 (残り{len(self.scratch_auth.waitings)}件)")
+
     @commands.Cog.listener()
     async def on_ready(self):
+        self.scratch_auth.cs_guild = self.bot.get_guild(int(os.environ.get("DISCORD_CS_SERVERID")))
         self.auth_view = csAuthStartView(self.scratch_auth, self.bot)
         self.bot.add_view(self.auth_view)
-        self.bot.tree.add_command(self.auth_command, override=True)
-        # await self.bot.tree.sync()
+        # 送信用のレイアウト。送信のたびにView storeへ登録されないよう終了済みにする
+        self.auth_view_layout = csAuthStartView(self.scratch_auth, self.bot)
+        self.auth_view_layout.stop()
 
     @app_commands.command(name="cs_auth", description="ユーザー認証のテンプレートを表示します。")
     @limit_command(only_cloudserver=True)
     async def auth_command(self, interaction: discord.Interaction):
         embed = discord.Embed(title="ユーザー認証", description="下のボタンを押して、☁システムとの連携を始めましょう！", color=0x4459fe)
         if _command_is_cs_admin(interaction):
-            await interaction.channel.send(embed=embed, view=self.auth_view)
+            await interaction.channel.send(embed=embed, view=self.auth_view_layout)
             await interaction.response.send_message("↓送信が完了しました", ephemeral=True)
         else:
-            await interaction.response.send_message(embed=embed, view=self.auth_view, ephemeral=True)
+            await interaction.response.send_message(embed=embed, view=self.auth_view_layout, ephemeral=True)
 
 
 async def setup(bot: commands.Bot):
@@ -346,6 +700,13 @@ if __name__ == "__main__":
     dotenv_path = path.join(path.abspath(path.join(path.dirname(__file__), os.pardir)), '.env')
     load_dotenv(dotenv_path)
 
-    scratch_auth = ScratchAuth()
+    async def _main():
+        http_client = HttpClient()
+        await http_client.start()
+        try:
+            scratch_auth = ScratchAuth(http_client=http_client)
+            print(await scratch_auth.get_tokens("comment", 0))
+        finally:
+            await http_client.close()
 
-    print(scratch_auth.get_tokens("comment"))
+    asyncio.run(_main())
@@ -1,14 +1,25 @@
-import re
+from __future__ import annotations  # scapiを遅延読み込みするため、型アノテーションを評価しない
+import os
 from logging import getLogger, StreamHandler, DEBUG, INFO
-from typing import Literal
+from typing import AsyncIterator, Literal, Optional
 import asyncio
+import time
 
 from discord import Embed, app_commands
 import discord
 from discord.ext import commands
-import scapi
 
-from ..templates import EmbedTemplates
+from ..lazy_import import lazy_import
+from ..templates import EmbedTemplates, limit_command
+from ..cache import TTLCache
+from ..metrics import metrics
+from ..unfurl_index import UnfurlRecord, UnfurlRecords
+from ..unfurl_limiter import UnfurlLimiter
+from ..scratch_links import SCRATCH_LINK, ScratchLinkType, extract_scratch_links
+from ..scratch_session import scratch_session
+
+# 起動時の読み込みを軽くするため、最初に使うときに読み込む
+scapi = lazy_import("scapi")
 
 logger = getLogger(__name__)
 handler = StreamHandler()
@@ -17,6 +28,17 @@ logger.setLevel(INFO)
 logger.addHandler(handler)
 logger.propagate = False
 
+# get_scratch_infoで同時に取得する件数と、1件あたりのタイムアウト(秒)
+FETCH_CONCURRENCY = int(os.environ.get("SCRATCH_FETCH_CONCURRENCY", 4))
+FETCH_TIMEOUT = float(os.environ.get("SCRATCH_FETCH_TIMEOUT", 8.0))
+
+# (タイプ, ID)をキーにScratchのデータを保持するキャッシュ
+info_cache = TTLCache(
+    maxsize=1024,
+    ttls={"projects": 10 * 60, "users": 30 * 60, "studios": 10 * 60},
+    stale_ttl=60 * 60,
+)
+
 
 class ScratchInfo:
     def __init__(self, url: str = None, type: Literal["projects", "users", "studios"] = None, id: str = None,
@@ -39,15 +61,16 @@ class ScratchInfo:
         if url:
             self.url = url
 
-            scratch_pattern = r"(https?://scratch\.mit\.edu/)(projects|users|studios)/([a-zA-Z0-9\-_]+)/*"
-            match = re.search(scratch_pattern, self.url)
+            match = SCRATCH_LINK.search(self.url)
             logger.debug(f"URL検出結果: {str(match)}")
             if not match:
                 logger.debug(f"URL検出失敗 {self.url}")
                 raise ValueError(f"{self.url}はScratchのURLではありません")
 
-            self.type = match.group(2)
-            self.id = match.group(3)
+            self.type = match.group(1)
+            self.id = match.group(2)
+            # 末尾のスラッシュなどの表記ゆれをなくす
+            self.url = f"https://scratch.mit.edu/{self.type}/{self.id}/"
             logger.debug(f"検出成功 タイプ: {self.type} ID: {self.id}")
         else:
             self.type = type
@@ -66,17 +89,42 @@ class ScratchInfo:
         self.bot_icon_url = bot_icon_url
         # await self._get_info()
 
-    async def _get_info(self) -> None:
+    @property
+    def cache_key(self) -> tuple[str, str]:
+        # ユーザー名は大文字小文字を区別しない
+        if self.type == "users":
+            return self.type, str(self.id).lower()
+        return self.type, str(self.id)
+
+    async def _fetch(self):
+        # 接続を使い回すため、Botで共有するセッションを使う
+        client_session = scratch_session.get()
         if self.type == "projects":
-            self.data = await scapi.get_project(self.id)
-            if not isinstance(self.data, scapi.Project):
+            data = await scapi.get_project(self.id, ClientSession=client_session)
+            if not isinstance(data, scapi.Project):
                 raise ValueError(f"プロジェクト {self.id} が見つかりません")
-            self.author: scapi.User = self.data.author
+            return data
         elif self.type == "users":
-            self.data = await scapi.get_user(self.id)
-            self.author: scapi.User = self.data
+            return await scapi.get_user(self.id, ClientSession=client_session)
         elif self.type == "studios":
-            self.data = await scapi.get_studio(self.id)
+            return await scapi.get_studio(self.id, ClientSession=client_session)
+
+    async def _get_info(self) -> None:
+        self._set_data(await info_cache.get_or_fetch(self.cache_key, self._fetch))
+
+    def _get_cached_info(self) -> bool:
+        """キャッシュにある場合だけ情報を設定します。問い合わせは行いません。"""
+        data = info_cache.peek(self.cache_key)
+        if data is None:
+            return False
+        self._set_data(data)
+        return True
+
+    def _set_data(self, data) -> None:
+        self.data = data
+        if self.type == "users":
+            self.author: scapi.User = self.data
+        else:
             self.author: scapi.User = self.data.author
 
     def get_embed(self, can_delete: bool = True) -> Embed:
@@ -112,18 +160,163 @@ class ScratchInfo:
         return embed
 
 
-async def get_scratch_info(text: str, bot_icon_url: str = None) -> list[ScratchInfo]:
-    scratch_pattern = r"https?://scratch\.mit\.edu/(projects|users|studios)/[a-zA-Z0-9\-_]+/*"
-    m = re.finditer(scratch_pattern, text)
-    data = []
-    for match in m:
+async def _try_resolve(info: ScratchInfo, semaphore: asyncio.Semaphore, timeout: float) -> Optional[str]:
+    """情報を取得し、失敗した場合はその理由を返します"""
+    async with semaphore:
         try:
-            info = ScratchInfo(text[match.start():match.end()], bot_icon_url=bot_icon_url)
-            await info._get_info()
-            data.append(info)
-        except ValueError:
-            logger.debug("情報取得失敗")
-    return data
+            await asyncio.wait_for(info._get_info(), timeout=timeout)
+            return None
+        except asyncio.TimeoutError:
+            logger.warning(f"情報取得がタイムアウトしました {info.url}")
+            return "タイムアウトしました"
+        except (ValueError, scapi.exception.ObjectFetchError):
+            logger.debug(f"情報取得失敗 {info.url}")
+            return "見つかりませんでした"
+
+
+async def _resolve(info: ScratchInfo, semaphore: asyncio.Semaphore, timeout: float) -> Optional[ScratchInfo]:
+    return info if await _try_resolve(info, semaphore, timeout) is None else None
+
+
+async def iter_scratch_links(links: list[tuple[ScratchLinkType, str]], bot_icon_url: str = None, *, concurrency: int = FETCH_CONCURRENCY,
+                             timeout: float = FETCH_TIMEOUT) -> AsyncIterator[tuple[int, ScratchInfo, Optional[str]]]:
+    """(タイプ, ID)の情報を並行して取得し、取得できたものから順に返します
+
+    Yields:
+        tuple[int, ScratchInfo, Optional[str]]: linksでの位置、情報、失敗した場合はその理由
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    infos = [ScratchInfo(type=link_type, id=link_id, bot_icon_url=bot_icon_url) for link_type, link_id in links]
+
+    async def resolve(index: int) -> tuple[int, ScratchInfo, Optional[str]]:
+        return index, infos[index], await _try_resolve(infos[index], semaphore, timeout)
+
+    tasks = [asyncio.create_task(resolve(index)) for index in range(len(infos))]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def fetch_scratch_links(links: list[tuple[ScratchLinkType, str]], bot_icon_url: str = None, *, concurrency: int = FETCH_CONCURRENCY,
+                              timeout: float = FETCH_TIMEOUT) -> list[ScratchInfo]:
+    """extract_scratch_linksで取り出した(タイプ, ID)の情報を並行して取得します
+
+    Args:
+        links (list[tuple[ScratchLinkType, str]]): 取得する(タイプ, ID)。重複は除かれている前提
+        bot_icon_url (str, optional): 埋め込みのフッターに表示するアイコンのURL
+        concurrency (int, optional): 同時に取得する最大件数
+        timeout (float, optional): 1件あたりのタイムアウト(秒)。超えたものだけ結果から除外されます
+
+    Returns:
+        list[ScratchInfo]: 取得できた情報。linksと同じ順
+    """
+    if not links:
+        return []
+
+    semaphore = asyncio.Semaphore(concurrency)
+    infos = [ScratchInfo(type=link_type, id=link_id, bot_icon_url=bot_icon_url) for link_type, link_id in links]
+    results = await asyncio.gather(*[_resolve(info, semaphore, timeout) for info in infos])
+    return [info for info in results if info is not None]
+
+
+def uncached_links(links: list[tuple[ScratchLinkType, str]]) -> list[tuple[ScratchLinkType, str]]:
+    """キャッシュになく、問い合わせが必要な(タイプ, ID)。linksと同じ順"""
+    return [link for link in links if info_cache.peek(link) is None]
+
+
+async def get_scratch_info(text: str, bot_icon_url: str = None, *, concurrency: int = FETCH_CONCURRENCY,
+                           timeout: float = FETCH_TIMEOUT) -> list[ScratchInfo]:
+    """テキストに含まれるScratchのURLから情報を取得します
+
+    同じ対象を指すURLは1つにまとめ、並行して取得します。
+
+    Args:
+        text (str): ScratchのURLを含むテキスト
+        bot_icon_url (str, optional): 埋め込みのフッターに表示するアイコンのURL
+        concurrency (int, optional): 同時に取得する最大件数
+        timeout (float, optional): 1件あたりのタイムアウト(秒)。超えたものだけ結果から除外されます
+
+    Returns:
+        list[ScratchInfo]: 取得できた情報。テキスト中の出現順
+    """
+    return await fetch_scratch_links(extract_scratch_links(text), bot_icon_url, concurrency=concurrency, timeout=timeout)
+
+
+class ProgressiveReply:
+    PAGE_SIZE = 10  # 1メッセージに付けられる埋め込みの上限
+
+    def __init__(self, interaction: discord.Interaction, urls: list[str], *, ephemeral: bool = False, started_at: Optional[float] = None):
+        """埋め込みを取得できたものから表示する返信
+
+        最初の埋め込みが届いた時点で、10件ずつのページに分けたメッセージを送信します。
+        取得中のものは仮の埋め込みで表示し、届いたものから編集で置き換えます。
+
+        Args:
+            interaction (discord.Interaction): 応答を保留済みのインタラクション
+            urls (list[str]): 表示するURL。仮の埋め込みに使います
+            ephemeral (bool, optional): 非公開で送信するか
+            started_at (Optional[float], optional): コマンドを受け取った時刻(time.perf_counter)。最初の埋め込みまでの時間の記録に使います
+        """
+        self.interaction = interaction
+        self.ephemeral = ephemeral
+        self.embeds = [Embed(title="取得中…", description=url, color=0x99aab5) for url in urls]
+        pages = (len(urls) + self.PAGE_SIZE - 1) // self.PAGE_SIZE
+        self.messages: list[discord.WebhookMessage] = []
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self._dirty = [False] * pages
+        self._locks = [asyncio.Lock() for _ in range(pages)]
+        self._send_lock = asyncio.Lock()
+        self._edits: set[asyncio.Task] = set()
+
+    def _page(self, page: int) -> list[Embed]:
+        return self.embeds[page * self.PAGE_SIZE:(page + 1) * self.PAGE_SIZE]
+
+    async def _send_pages(self) -> None:
+        async with self._send_lock:
+            # ページの順番を保つため、まとめて順に送信する
+            while len(self.messages) < len(self._dirty):
+                page = len(self.messages)
+                self._dirty[page] = False
+                message = await self.interaction.followup.send(embeds=self._page(page), ephemeral=self.ephemeral, wait=True)
+                # 取得中や途中で失敗した場合でも、送信済みのページをリアクションで削除できるようにする
+                self.interaction.client.unfurl_index.add(message.id, self.interaction.user.id)
+                if not self.messages:
+                    metrics.observe("scratch_fetch.time_to_first_embed", time.perf_counter() - self.started_at)
+                self.messages.append(message)
+
+    async def _edit(self, page: int) -> None:
+        # 編集中に届いたものは、編集が終わってからまとめて反映する
+        async with self._locks[page]:
+            while self._dirty[page]:
+                self._dirty[page] = False
+                try:
+                    await self.messages[page].edit(embeds=self._page(page))
+                except discord.HTTPException as e:
+                    logger.warning(f"埋め込みの編集に失敗しました {e}")
+
+    async def set(self, index: int, embed: Embed) -> None:
+        """index番目の埋め込みを置き換えます"""
+        self.embeds[index] = embed
+        page = index // self.PAGE_SIZE
+        self._dirty[page] = True
+        if len(self.messages) < len(self._dirty):
+            await self._send_pages()
+        if self._dirty[page] and not self._locks[page].locked():
+            task = asyncio.create_task(self._edit(page))
+            self._edits.add(task)
+            task.add_done_callback(self._edits.discard)
+
+    async def finish(self) -> None:
+        """未送信のページと編集を反映し終えるまで待ちます"""
+        await self._send_pages()
+        while self._edits:
+            await asyncio.gather(*self._edits)
+        for page, dirty in enumerate(self._dirty):
+            if dirty:
+                await self._edit(page)
 
 
 class ScratchInfoCog(commands.Cog):
@@ -132,33 +325,153 @@ class ScratchInfoCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.bot_icon_url = "https://api.takechi.cloud/src/icon/takechi_v2.1.png"
+        # 編集時の再展開に使う、返信した埋め込みの記録
+        self.unfurls = UnfurlRecords()
+        # 展開による問い合わせの制限
+        self.limiter = UnfurlLimiter()
+        # 展開中の元メッセージと、その間に届いた最新の編集
+        self._unfurling: dict[int, Optional[discord.Message]] = {}
         # self.bot.tree.add_command(self.scratch_embed)
 
+    async def cog_load(self):
+        self.bot.message_router.add_handler("scratch_info", self.unfurl, scratch_links=True)
+
+    async def cog_unload(self):
+        self.bot.message_router.remove_handler("scratch_info")
+
     @app_commands.command(name="scratch_fetch", description="Scratchのプロジェクト・ユーザー・スタジオの情報を取得して表示します。")
     @discord.app_commands.describe(
         text="ScratchのURLを含むテキスト",
         ephemeral="非公開で作成するか (Trueで非公開)"
     )
     async def scratch_embed(self, interaction: discord.Interaction, text: str, ephemeral: bool = False):
+        start = time.perf_counter()
         await interaction.response.defer(ephemeral=ephemeral)
 
-        app_info = await self.bot.application_info()
-        data = await get_scratch_info(text, app_info.icon.url)
-        if data:
-            await interaction.followup.send(embeds=[scratch_info.get_embed() for scratch_info in data])
-        else:
+        links = extract_scratch_links(text)
+        if not links:
             await interaction.followup.send(embed=EmbedTemplates.scratch_no_found)
+            return
+
+        # 取得できたものから送信し、残りは編集で追加する
+        reply = ProgressiveReply(interaction, [ScratchInfo(type=link_type, id=link_id).url for link_type, link_id in links],
+                                 ephemeral=ephemeral, started_at=start)
+        async for index, scratch_info, error in iter_scratch_links(links, await self.bot.app_info.icon_url() or self.bot_icon_url):
+            if error is None:
+                embed = scratch_info.get_embed()
+            else:
+                embed = Embed(title="取得できませんでした", description=f"{scratch_info.url}\n{error}", color=0xf04747)
+            await reply.set(index, embed)
+
+        await reply.finish()
+        metrics.observe("scratch_fetch.total", time.perf_counter() - start)
+
+    @app_commands.command(name="admin_scratch_cache", description="Scratch情報キャッシュの統計を表示します。")
+    @limit_command(only_admin=True, only_cloudserver=True)
+    async def cache_stats_command(self, interaction: discord.Interaction):
+        stats = info_cache.stats.to_dict()
+        lines = [f"{name}: {value}" for name, value in stats.items()]
+        embed = discord.Embed(title="Scratch情報キャッシュ", description=f"件数: {len(info_cache)} / {info_cache.maxsize}\n" + "\n".join(lines), color=0x558aff)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    async def _fetch_embeds(self, message: discord.Message, links: list[tuple[ScratchLinkType, str]]) -> dict[tuple[str, str], Embed]:
+        """レート制限の範囲で情報を取得します。制限を超えた分はキャッシュにあるものだけを返します。"""
+        bot_icon_url = await self.bot.app_info.icon_url() or self.bot_icon_url
+        uncached = uncached_links(links)
+        allowed = await self.limiter.admit(message.author.id, message.channel.id, len(uncached))
+        # 許可されなかった対象は埋め込みを付けず、メッセージ中のURLのままにする
+        skipped = set(uncached[allowed:])
+        if skipped:
+            metrics.incr("unfurl_limit.cache_only", len(skipped))
+        data = await fetch_scratch_links([link for link in links if link not in skipped], bot_icon_url)
+        return {scratch_info.cache_key: scratch_info.get_embed() for scratch_info in data}
+
+    async def unfurl(self, message: discord.Message):
+        """ScratchのURLを含むメッセージに情報の埋め込みを返信します。除外の判定はMessageRouterで済んでいます。"""
+        if message.id in self._unfurling:
+            return
+        # 返信するまでに届いた編集で、もう1つ返信しないようにする
+        self._unfurling[message.id] = None
+        try:
+            # 1つの返信に付けられる分だけを対象にする
+            links = extract_scratch_links(message.content)[:ProgressiveReply.PAGE_SIZE]
+            embeds = await self._fetch_embeds(message, links)
+            if embeds:
+                reply = await message.reply(embeds=list(embeds.values()), mention_author=False)
+                self.bot.unfurl_index.add(reply.id, message.author.id, message.id)
+                self.unfurls.add(message.id, UnfurlRecord(reply_id=reply.id, links=links, embeds=embeds))
+        finally:
+            edited = self._unfurling.pop(message.id, None)
+        if edited is not None:
+            await self._apply_edit(edited)
 
     @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        if message.author == self.bot.user:  # 自分自身
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        """編集で変わったリンクだけを取得し、返信を編集します
+
+        on_message_editはキャッシュにあるメッセージでしか呼ばれないため、raw版を使います。
+        """
+        message = payload.message
+        if message.author.bot:
+            return
+        if message.id in self._unfurling:
+            # 展開が終わってから反映する
+            self._unfurling[message.id] = message
+            return
+        await self._apply_edit(message)
+
+    async def _apply_edit(self, message: discord.Message):
+        links = [] if "<embed_skip>" in message.content else extract_scratch_links(message.content)[:ProgressiveReply.PAGE_SIZE]
+
+        record = self.unfurls.get(message.id)
+        if record is None:
+            # 記録がなく返信もしていないメッセージだけ、新しく返信する
+            if not links or self.bot.unfurl_index.reply_for(message.id) is not None:
+                return
+            if (discord.utils.utcnow() - message.created_at).total_seconds() > self.unfurls.max_age:
+                return
+            metrics.incr("unfurl_edit.new")
+            await self.unfurl(message)
             return
 
-        if "<embed_skip>" not in message.content:
-            app_info = await self.bot.application_info()
-            data = await get_scratch_info(message.content, app_info.icon.url)
-            if data:
-                await message.reply(embeds=[scratch_info.get_embed() for scratch_info in data], mention_author=False)
+        # 返信が削除済みの場合や、埋め込みの展開による更新などでリンクが変わっていない場合
+        if record.reply_id is None or links == record.links:
+            return
+        # 返信が削除済みの場合は作り直さない
+        if self.bot.unfurl_index.get(record.reply_id) is None:
+            self._forget_reply(message.id, record)
+            return
+
+        new_links = [link for link in links if link not in record.embeds]
+        embeds = {link: record.embeds[link] for link in links if link in record.embeds}
+        embeds.update(await self._fetch_embeds(message, new_links))
+        ordered = [embeds[link] for link in links if link in embeds]
+        metrics.incr("unfurl_edit.fetched", len(new_links))
+        metrics.incr("unfurl_edit.reused", len(links) - len(new_links))
+
+        reply = message.channel.get_partial_message(record.reply_id)
+        try:
+            if ordered:
+                await reply.edit(embeds=ordered)
+            else:
+                await reply.delete()
+                self.bot.unfurl_index.on_message_deleted(record.reply_id)
+        except discord.NotFound:
+            self._forget_reply(message.id, record)
+            return
+
+        if ordered:
+            self.unfurls.add(message.id, UnfurlRecord(reply_id=record.reply_id, links=links, embeds=embeds))
+        else:
+            self.unfurls.pop(message.id)
+
+    def _forget_reply(self, origin_id: int, record: UnfurlRecord) -> None:
+        """返信が削除されたことを記録し、以降の編集で作り直さないようにします"""
+        self.unfurls.add(origin_id, UnfurlRecord(reply_id=None, links=record.links, embeds={}))
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.unfurls.pop(payload.message_id)
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -0,0 +1,76 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from logging import getLogger, StreamHandler, DEBUG
+from typing import Optional
+
+from discord import app_commands
+
+from discordbot.metrics import metrics
+from discordbot.storage import data_path
+
+logger = getLogger(__name__)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+
+class CommandSync:
+    def __init__(self, tree: app_commands.CommandTree, path: Optional[str] = None):
+        """コマンドツリーに変更があった場合だけ同期します
+
+        ツリーを送信する形式に変換してハッシュを取り、前回同期したときのハッシュと比較します。
+
+        Args:
+            tree (app_commands.CommandTree): 対象のコマンドツリー
+            path (Optional[str], optional): ハッシュの保存先。省略時はdata/command_tree.sha256
+        """
+        self.tree = tree
+        self.path = path or data_path("command_tree.sha256")
+        self._lock = asyncio.Lock()
+
+    def fingerprint(self) -> str:
+        """コマンドツリーのハッシュを返します。コマンドの順番には依存しません。"""
+        payload = sorted((command.to_dict(self.tree) for command in self.tree.get_commands()), key=lambda x: (x.get("type", 1), x["name"]))
+        # アプリケーションが変わった場合も同期する
+        data = json.dumps({"application_id": self.tree.client.application_id, "commands": payload}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _stored(self) -> Optional[str]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, encoding="utf-8") as f:
+            return f.read().strip() or None
+
+    def _store(self, fingerprint: str) -> None:
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(fingerprint)
+
+    async def sync(self, *, force: bool = False) -> Optional[list[app_commands.AppCommand]]:
+        """必要な場合だけコマンドツリーを同期します
+
+        Args:
+            force (bool, optional): Trueの場合は変更がなくても同期します
+
+        Returns:
+            Optional[list[app_commands.AppCommand]]: 同期したコマンド。同期しなかった場合はNone
+        """
+        async with self._lock:
+            fingerprint = self.fingerprint()
+            if not force and fingerprint == self._stored():
+                metrics.incr("command_sync.skipped")
+                logger.info("コマンドツリーに変更がないため同期しませんでした")
+                return None
+
+            start = time.perf_counter()
+            synced_commands = await self.tree.sync()
+            elapsed = time.perf_counter() - start
+            self._store(fingerprint)
+
+            metrics.observe("command_sync.sync", elapsed)
+            logger.info(f"コマンドツリーを同期しました {len(synced_commands)}件 {elapsed * 1000:.0f}ms")
+            return synced_commands
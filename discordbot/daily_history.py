@@ -0,0 +1,150 @@
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from discordbot.http_client import HttpClient
+
+
+@dataclass
+class OutboxEntry:
+    id: int
+    payload: dict[str, Any]
+    attempts: int
+
+
+class DailyHistory:
+    def __init__(self, path: str):
+        """今日の作品の履歴をローカルに保持するストア
+
+        APIの履歴を差分で取り込み、掲載済みかどうかや最終送信時刻を手元で答えます。
+        APIへの登録はoutboxに書き込み、あとから再送します。
+
+        Args:
+            path (str): SQLiteファイルのパス
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                project_id INTEGER PRIMARY KEY,
+                title TEXT,
+                timestamp INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                etag TEXT,
+                last_modified TEXT,
+                synced_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                last_error TEXT
+            );
+        """)
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def is_featured(self, project_id: int) -> bool:
+        return self._conn.execute("SELECT 1 FROM history WHERE project_id = ?", (project_id,)).fetchone() is not None
+
+    def featured_ids(self) -> set[int]:
+        return {row[0] for row in self._conn.execute("SELECT project_id FROM history")}
+
+    def last_sent(self) -> Optional[int]:
+        return self._conn.execute("SELECT MAX(timestamp) FROM history").fetchone()[0]
+
+    def synced_at(self) -> Optional[float]:
+        row = self._conn.execute("SELECT synced_at FROM sync_state WHERE id = 0").fetchone()
+        return row[0] if row else None
+
+    def record(self, project_id: int, title: Optional[str], timestamp: Optional[int] = None) -> None:
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO history (project_id, title, timestamp) VALUES (?, ?, ?)",
+                (project_id, title, int(timestamp or time.time()))
+            )
+
+    def merge(self, entries: list[dict[str, Any]]) -> int:
+        """APIの履歴を取り込み、新しく追加された件数を返します"""
+        before = self.count()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO history (project_id, title, timestamp) VALUES (?, ?, ?)",
+                [(int(entry["id"]), entry.get("title"), int(entry["timestamp"])) for entry in entries]
+            )
+        return self.count() - before
+
+    async def sync(self, http_client: HttpClient, url: str) -> int:
+        """APIの履歴と同期します
+
+        前回のETag/Last-Modifiedを送り、変更がなければ本文を受け取りません。
+
+        Raises:
+            ConnectionError: APIがエラーを返した場合
+
+        Returns:
+            int: 新しく取り込んだ件数
+        """
+        headers = {}
+        row = self._conn.execute("SELECT etag, last_modified FROM sync_state WHERE id = 0").fetchone()
+        if row and self.count():
+            if row[0]:
+                headers["If-None-Match"] = row[0]
+            if row[1]:
+                headers["If-Modified-Since"] = row[1]
+
+        res = await http_client.get(url, headers=headers)
+        if res.status == 304:
+            added = 0
+        else:
+            if not res.headers.get("Content-Type", "").startswith("application/json"):
+                raise ConnectionError(f"APIの取得に失敗しました コード: {res.status}")
+            res_json = res.json()
+            if res_json["code"] != 200:
+                raise ConnectionError(f"API側でエラーが発生しました {res.text}")
+            added = self.merge(res_json["data"])
+
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state (id, etag, last_modified, synced_at) VALUES (0, ?, ?, ?)",
+                (res.headers.get("ETag"), res.headers.get("Last-Modified"), time.time())
+            )
+        return added
+
+    def enqueue(self, payload: dict[str, Any]) -> int:
+        """APIに送信する内容をoutboxに書き込みます"""
+        with self._conn:
+            cursor = self._conn.execute("INSERT INTO outbox (payload) VALUES (?)", (json.dumps(payload),))
+        return cursor.lastrowid
+
+    def due_outbox(self) -> list[OutboxEntry]:
+        rows = self._conn.execute(
+            "SELECT id, payload, attempts FROM outbox WHERE next_attempt <= ? ORDER BY id", (time.time(),)
+        )
+        return [OutboxEntry(id=row[0], payload=json.loads(row[1]), attempts=row[2]) for row in rows]
+
+    def outbox_size(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def mark_sent(self, entry_id: int) -> None:
+        with self._conn:
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def mark_failed(self, entry_id: int, error: str, retry_after: float) -> None:
+        with self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE id = ?",
+                (time.time() + retry_after, error, entry_id)
+            )
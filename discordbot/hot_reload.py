@@ -1,12 +1,35 @@
 from logging import getLogger, StreamHandler, DEBUG, Logger
+import ast
+import hashlib
+import importlib
 import pathlib
+import sys
+import time
+from typing import Iterable, Optional
 
 from discord.ext import commands
 from watchfiles import awatch, Change
 
+from discordbot.metrics import metrics
+
+PACKAGE_DIR = pathlib.Path(__file__).resolve().parent
+
 
 class HotReload:
-    def __init__(self, bot: commands.Bot, *, logger=None):
+    # 状態を持つため、変更されてもリロードしないモジュール
+    NEVER_RELOAD = {"discordbot.__main__", "discordbot.hot_reload", "discordbot.metrics"}
+
+    def __init__(self, bot: commands.Bot, *, logger=None, root: Optional[pathlib.Path] = None, debounce: int = 800):
+        """パッケージ内のファイルの変更を監視し、影響を受けるCogをリロードします
+
+        変更はまとめて受け取り、内容が変わったファイルだけを対象にします。
+        共有モジュールが変更された場合は、それをimportしているCogもリロードします。
+
+        Args:
+            bot (commands.Bot): 対象のBot
+            root (Optional[pathlib.Path], optional): 監視するパッケージのディレクトリ
+            debounce (int, optional): 変更をまとめる時間(ミリ秒)
+        """
         self.bot = bot
         if logger:
             self.logger: Logger = logger
@@ -18,16 +41,146 @@ class HotReload:
             self.logger.addHandler(handler)
             self.logger.propagate = False
 
+        self.root = root or PACKAGE_DIR
+        self.debounce = debounce
+        self._hashes: dict[pathlib.Path, str] = {}
+        # ファイルのハッシュごとのimport先
+        self._imports: dict[str, set[str]] = {}
+        for path in self.root.rglob("*.py"):
+            self._hashes[path] = self._hash(path)
+
         self.logger.info("HotReload initialized")
 
+    @staticmethod
+    def _hash(path: pathlib.Path) -> Optional[str]:
+        try:
+            return hashlib.sha256(path.read_bytes()).hexdigest()
+        except OSError:
+            return None
+
+    def module_name(self, path: pathlib.Path) -> str:
+        parts = list(path.resolve().relative_to(self.root.parent).with_suffix("").parts)
+        if parts[-1] == "__init__":
+            parts.pop()
+        return ".".join(parts)
+
+    def _modules(self) -> dict[str, pathlib.Path]:
+        return {self.module_name(path): path for path in self.root.rglob("*.py")}
+
+    def _parse_imports(self, module: str, path: pathlib.Path, known: Iterable[str]) -> set[str]:
+        digest = self._hashes.get(path) or self._hash(path)
+        if digest in self._imports:
+            return self._imports[digest]
+
+        known = set(known)
+        package = module.split(".") if path.name == "__init__.py" else module.split(".")[:-1]
+        imports = set()
+        try:
+            tree = ast.parse(path.read_bytes(), filename=str(path))
+        except (OSError, SyntaxError):
+            return imports
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                imports.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                if node.level:
+                    base = package[:len(package) - node.level + 1]
+                    target = ".".join(base + ([node.module] if node.module else []))
+                else:
+                    target = node.module or ""
+                imports.add(target)
+                # from . import x のようにモジュールを直接importしている場合
+                imports.update(f"{target}.{alias.name}" for alias in node.names)
+
+        imports = {name for name in imports if name in known and name != module}
+        if digest:
+            self._imports[digest] = imports
+        return imports
+
+    def dependents(self, changed: set[str]) -> list[str]:
+        """変更されたモジュールと、それに依存するモジュールを依存される順に返します"""
+        modules = self._modules()
+        graph = {module: self._parse_imports(module, path, modules) for module, path in modules.items()}
+
+        affected = set(changed)
+        while True:
+            added = {module for module, imports in graph.items() if module not in affected and imports & affected}
+            if not added:
+                break
+            affected |= added
+
+        ordered: list[str] = []
+        visiting: set[str] = set()
+
+        def visit(module: str):
+            if module in ordered or module in visiting:
+                return
+            visiting.add(module)
+            for dependency in graph.get(module, ()):
+                if dependency in affected:
+                    visit(dependency)
+            visiting.discard(module)
+            ordered.append(module)
+
+        for module in sorted(affected):
+            visit(module)
+        return ordered
+
+    def _changed_modules(self, changes: set[tuple[Change, str]]) -> set[str]:
+        changed = set()
+        for change, raw_path in changes:
+            path = pathlib.Path(raw_path).resolve()
+            if path.suffix != ".py":
+                continue
+            if change == Change.deleted:
+                self._hashes.pop(path, None)
+                continue
+
+            digest = self._hash(path)
+            if digest is None or self._hashes.get(path) == digest:
+                continue
+            self._hashes[path] = digest
+            changed.add(self.module_name(path))
+        return changed
+
+    async def reload(self, changed: set[str]) -> dict[str, float]:
+        """変更されたモジュールを反映します
+
+        Returns:
+            dict[str, float]: リロードしたモジュールごとの所要時間(秒)
+        """
+        timings: dict[str, float] = {}
+        for module in self.dependents(changed):
+            if module in self.NEVER_RELOAD:
+                continue
+
+            start = time.perf_counter()
+            try:
+                if module in self.bot.extensions:
+                    await self.bot.reload_extension(module)
+                elif module.startswith(f"{self.root.name}.cogs.") and module in changed:
+                    await self.bot.load_extension(module)
+                elif module in sys.modules:
+                    importlib.reload(sys.modules[module])
+                else:
+                    continue
+            except Exception as e:
+                self.logger.error(f"Failed to reload {module}: {e}")
+                continue
+            timings[module] = time.perf_counter() - start
+        return timings
+
     async def watch_files(self):
-        async for changes in awatch("discordbot/cogs"):
-            for change in changes:
-                if change[0] == Change.modified or change[0] == Change.added:
-                    cog_name = pathlib.Path(change[1]).parts[-1][:-3]  # Windows/Linux 両対応
-                    self.logger.info(f"Detected change in {cog_name}, reloading...")
-                    try:
-                        await self.bot.reload_extension(f"discordbot.cogs.{cog_name}")
-                        self.logger.info(f"Reloaded {cog_name}")
-                    except Exception as e:
-                        self.logger.error(f"Failed to reload {cog_name}: {e}")
+        async for changes in awatch(self.root, debounce=self.debounce):
+            changed = self._changed_modules(changes)
+            if not changed:
+                continue
+
+            self.logger.info(f"Detected change in {', '.join(sorted(changed))}, reloading...")
+            start = time.perf_counter()
+            timings = await self.reload(changed)
+            elapsed = time.perf_counter() - start
+            metrics.observe("hot_reload.cycle", elapsed)
+            details = ", ".join(f"{module}: {seconds * 1000:.0f}ms" for module, seconds in timings.items())
+            self.logger.info(f"Reloaded {len(timings)} modules in {elapsed * 1000:.0f}ms ({details})")
@@ -0,0 +1,98 @@
+import json
+from logging import getLogger, StreamHandler, DEBUG, Logger
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import aiohttp
+from multidict import CIMultiDictProxy
+
+
+@dataclass
+class HttpResponse:
+    """本文まで読み込み済みのレスポンス"""
+    status: int
+    headers: CIMultiDictProxy
+    text: str
+    url: str
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+
+class HttpClient:
+    def __init__(self, *, limit: int = 100, limit_per_host: int = 10, keepalive_timeout: float = 30.0,
+                 timeout: float = 10.0, connect_timeout: float = 5.0, logger=None):
+        """Bot全体で共有する非同期HTTPクライアント
+
+        Args:
+            limit (int, optional): 全体の同時接続数の上限
+            limit_per_host (int, optional): ホストごとの同時接続数の上限
+            keepalive_timeout (float, optional): 使い終わった接続を保持する秒数
+            timeout (float, optional): リクエスト全体のタイムアウト秒数
+            connect_timeout (float, optional): 接続確立までのタイムアウト秒数
+        """
+        if logger:
+            self.logger: Logger = logger
+        else:
+            self.logger: Logger = getLogger(__name__)
+            handler = StreamHandler()
+            handler.setLevel(DEBUG)
+            self.logger.setLevel(DEBUG)
+            self.logger.addHandler(handler)
+            self.logger.propagate = False
+
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    async def start(self) -> None:
+        """セッションを作成します。すでに開始している場合は何もしません。"""
+        if not self.closed:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        self.logger.info("HttpClient started")
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        await self._session.close()
+        self._session = None
+        self.logger.info("HttpClient closed")
+
+    async def request(self, method: str, url: str, *, params: Optional[dict] = None, json: Any = None,
+                      headers: Optional[dict] = None, timeout: Optional[float] = None) -> HttpResponse:
+        """リクエストを送信し、本文まで読み込んだレスポンスを返します
+
+        Raises:
+            RuntimeError: startされていない場合
+            aiohttp.ClientError: 通信に失敗した場合
+            asyncio.TimeoutError: タイムアウトした場合
+        """
+        if self.closed:
+            raise RuntimeError("HttpClientが開始されていません")
+
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+
+        async with self._session.request(method, url, params=params, json=json, headers=headers, **kwargs) as res:
+            text = await res.text()
+            return HttpResponse(status=res.status, headers=res.headers, text=text, url=str(res.url))
+
+    async def get(self, url: str, **kwargs) -> HttpResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> HttpResponse:
+        return await self.request("POST", url, **kwargs)
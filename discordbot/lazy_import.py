@@ -0,0 +1,32 @@
+import importlib.util
+import sys
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """モジュールを最初に属性へアクセスしたときに読み込みます
+
+    起動時に使わない重いモジュールの読み込みを後回しにするために使います。
+    すでに読み込まれている場合はそのモジュールを返します。
+
+    Args:
+        name (str): モジュール名
+
+    Raises:
+        ModuleNotFoundError: モジュールが見つからない場合
+
+    Returns:
+        ModuleType: 読み込みを遅延したモジュール
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,78 @@
+from logging import getLogger, StreamHandler, DEBUG
+from typing import Awaitable, Callable
+
+import discord
+
+from discordbot.metrics import metrics
+
+logger = getLogger(__name__)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+MessageHandler = Callable[[discord.Message], Awaitable[None]]
+
+
+class MessageRouter:
+    def __init__(self):
+        """on_messageを1か所で受け取り、登録された処理に振り分けます
+
+        awaitを行う前に文字列の比較だけで対象外のメッセージを除外し、除外した段階ごとに件数を数えます。
+        """
+        self._handlers: dict[str, MessageHandler] = {}
+        self._link_handlers: dict[str, MessageHandler] = {}
+
+    def add_handler(self, name: str, handler: MessageHandler, *, scratch_links: bool = False) -> None:
+        """処理を登録します。同じ名前の処理は置き換えます。
+
+        Args:
+            name (str): 処理の名前
+            handler (MessageHandler): メッセージを受け取るコルーチン関数
+            scratch_links (bool, optional): Trueの場合、ScratchのURLを含むメッセージだけを渡します
+        """
+        self.remove_handler(name)
+        if scratch_links:
+            self._link_handlers[name] = handler
+        else:
+            self._handlers[name] = handler
+
+    def remove_handler(self, name: str) -> None:
+        self._handlers.pop(name, None)
+        self._link_handlers.pop(name, None)
+
+    @staticmethod
+    def _drop(stage: str) -> None:
+        metrics.incr(f"message_router.dropped.{stage}")
+
+    async def _dispatch(self, handlers: dict[str, MessageHandler], message: discord.Message) -> None:
+        for name, handler in list(handlers.items()):
+            try:
+                await handler(message)
+            except Exception as e:
+                metrics.incr(f"message_router.errors.{name}")
+                logger.error(f"メッセージの処理中にエラーが発生しました {name}: {e}")
+
+    async def on_message(self, message: discord.Message) -> None:
+        metrics.incr("message_router.received")
+        if message.author.bot:
+            self._drop("bot")
+            return
+
+        if self._handlers:
+            await self._dispatch(self._handlers, message)
+
+        content = message.content
+        if "<embed_skip>" in content:
+            self._drop("embed_skip")
+            return
+        if "scratch.mit.edu" not in content:
+            self._drop("no_scratch_link")
+            return
+        if not self._link_handlers:
+            self._drop("no_handler")
+            return
+
+        metrics.incr("message_router.routed")
+        await self._dispatch(self._link_handlers, message)
@@ -0,0 +1,51 @@
+from collections import defaultdict
+from dataclasses import dataclass
+
+
+@dataclass
+class LatencyStat:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+class Metrics:
+    """Bot全体で共有するカウンターと所要時間の記録"""
+
+    def __init__(self):
+        self.counters: dict[str, int] = defaultdict(int)
+        self.latencies: dict[str, LatencyStat] = defaultdict(LatencyStat)
+        self.gauges: dict[str, float] = {}
+
+    def incr(self, name: str, value: int = 1) -> None:
+        self.counters[name] += value
+
+    def observe(self, name: str, seconds: float) -> None:
+        self.latencies[name].record(seconds)
+
+    def gauge(self, name: str, value: float) -> None:
+        """現在値を記録します"""
+        self.gauges[name] = value
+
+    def lines(self, prefix: str = "") -> list[str]:
+        """表示用に整形した一覧を返します"""
+        lines = [f"{name}: {value}" for name, value in sorted(self.counters.items()) if name.startswith(prefix)]
+        lines += [f"{name}: {value:g}" for name, value in sorted(self.gauges.items()) if name.startswith(prefix)]
+        lines += [
+            f"{name}: {stat.count}回 平均{stat.average * 1000:.2f}ms 最大{stat.max * 1000:.2f}ms"
+            for name, stat in sorted(self.latencies.items()) if name.startswith(prefix)
+        ]
+        return lines
+
+
+metrics = Metrics()
@@ -0,0 +1,282 @@
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, Literal, Optional
+
+from discordbot.storage import data_path
+
+
+class PendingAuthBusyError(ConnectionError):
+    """他のプロセスが書き込み中のため、認証待ちを更新できなかった場合の例外。認証待ちは変更されていないため、後で再試行できます"""
+
+
+@dataclass
+class WaitingData:
+    public_code: str
+    private_code: str
+    method: Literal["cloud", "comment", "profile-comment"]
+    username: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+
+
+class PendingAuthStore(ABC):
+    """認証待ちのデータを保持するストアのインターフェース
+
+    DiscordIDと秘密鍵の両方から引けるようにし、期限切れと件数の上限で大きさを抑えます。
+    複数のプロセスで共有できる実装であれば、どのプロセスでも認証を完了できます。
+    """
+
+    def __init__(self, *, ttl: float = 30 * 60, maxsize: int = 10000):
+        """
+        Args:
+            ttl (float, optional): 認証待ちの有効期間(秒)
+            maxsize (int, optional): 保持する最大件数。超えた場合は古いものから削除
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.evictions = 0
+        self.expirations = 0
+
+    def __contains__(self, discord_id: int) -> bool:
+        return self.get(discord_id) is not None
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[tuple[int, WaitingData]]:
+        """期限内の認証待ちを作成順に返します"""
+
+    @abstractmethod
+    def put(self, discord_id: int, waiting: WaitingData) -> None:
+        """認証待ちを登録します。同じユーザーの古いデータは置き換えます。"""
+
+    @abstractmethod
+    def get(self, discord_id: int) -> Optional[WaitingData]:
+        pass
+
+    @abstractmethod
+    def pop(self, discord_id: int) -> Optional[WaitingData]:
+        pass
+
+    @abstractmethod
+    def pop_by_private_code(self, private_code: str) -> Optional[tuple[int, WaitingData]]:
+        """秘密鍵から認証待ちを取り出します。複数のプロセスから呼ばれても1回だけ取り出せます。
+
+        Returns:
+            Optional[tuple[int, WaitingData]]: DiscordIDと認証待ちのデータ。見つからない、または期限切れの場合はNone
+        """
+
+    @abstractmethod
+    def sweep(self) -> int:
+        """期限切れのデータを削除し、削除した件数を返します"""
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryPendingAuthStore(PendingAuthStore):
+    """プロセスのメモリ上に保持するストア"""
+
+    def __init__(self, *, ttl: float = 30 * 60, maxsize: int = 10000):
+        super().__init__(ttl=ttl, maxsize=maxsize)
+
+        # 作成順に並ぶため、先頭から期限切れを確認できる
+        self._entries: OrderedDict[int, WaitingData] = OrderedDict()
+        self._by_private_code: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[tuple[int, WaitingData]]:
+        now = time.time()
+        return iter([(discord_id, waiting) for discord_id, waiting in self._entries.items() if not self._expired(waiting, now)])
+
+    def _expired(self, waiting: WaitingData, now: float) -> bool:
+        return waiting.created_at + self.ttl <= now
+
+    def _remove(self, discord_id: int) -> Optional[WaitingData]:
+        waiting = self._entries.pop(discord_id, None)
+        if waiting is not None:
+            self._by_private_code.pop(waiting.private_code, None)
+        return waiting
+
+    def put(self, discord_id: int, waiting: WaitingData) -> None:
+        self._remove(discord_id)
+        self._entries[discord_id] = waiting
+        self._by_private_code[waiting.private_code] = discord_id
+
+        while len(self._entries) > self.maxsize:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def get(self, discord_id: int) -> Optional[WaitingData]:
+        waiting = self._entries.get(discord_id)
+        if waiting is None:
+            return None
+        if self._expired(waiting, time.time()):
+            self._remove(discord_id)
+            self.expirations += 1
+            return None
+        return waiting
+
+    def pop(self, discord_id: int) -> Optional[WaitingData]:
+        waiting = self.get(discord_id)
+        if waiting is not None:
+            self._remove(discord_id)
+        return waiting
+
+    def pop_by_private_code(self, private_code: str) -> Optional[tuple[int, WaitingData]]:
+        discord_id = self._by_private_code.get(private_code)
+        if discord_id is None:
+            return None
+        waiting = self.pop(discord_id)
+        if waiting is None:
+            return None
+        return discord_id, waiting
+
+    def sweep(self) -> int:
+        now = time.time()
+        removed = 0
+        while self._entries:
+            discord_id, waiting = next(iter(self._entries.items()))
+            if not self._expired(waiting, now):
+                break
+            self._remove(discord_id)
+            removed += 1
+
+        self.expirations += removed
+        return removed
+
+
+class SQLitePendingAuthStore(PendingAuthStore):
+    """SQLite(WALモード)に保持するストア
+
+    同じマシン上の複数のプロセスで共有でき、再起動後も認証待ちを引き継げます。
+    """
+
+    def __init__(self, path: str, *, ttl: float = 30 * 60, maxsize: int = 10000, busy_timeout: float = 0.05):
+        """
+        Args:
+            path (str): SQLiteファイルのパス
+            ttl (float, optional): 認証待ちの有効期間(秒)
+            maxsize (int, optional): 保持する最大件数。超えた場合は古いものから削除
+            busy_timeout (float, optional): 他のプロセスの書き込みを待つ最大秒数。イベントループを止めるため短くします
+        """
+        super().__init__(ttl=ttl, maxsize=maxsize)
+        self.path = path
+        # トランザクションは明示的に開始する
+        self._conn = sqlite3.connect(path, isolation_level=None, timeout=busy_timeout)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pending_auth (
+                discord_id INTEGER PRIMARY KEY,
+                public_code TEXT NOT NULL,
+                private_code TEXT NOT NULL UNIQUE,
+                method TEXT NOT NULL,
+                username TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pending_auth_created_at ON pending_auth (created_at);
+        """)
+
+    _COLUMNS = "discord_id, public_code, private_code, method, username, created_at"
+
+    @staticmethod
+    @contextmanager
+    def _writing():
+        """書き込みのロックを取れなかった場合に、PendingAuthBusyErrorにします"""
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                raise PendingAuthBusyError(f"認証待ちのデータベースが使用中です {e}") from e
+            raise
+
+    @staticmethod
+    def _to_waiting(row: tuple) -> WaitingData:
+        return WaitingData(public_code=row[1], private_code=row[2], method=row[3], username=row[4], created_at=row[5])
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM pending_auth WHERE created_at > ?", (time.time() - self.ttl,)).fetchone()[0]
+
+    def __iter__(self) -> Iterator[tuple[int, WaitingData]]:
+        rows = self._conn.execute(
+            f"SELECT {self._COLUMNS} FROM pending_auth WHERE created_at > ? ORDER BY created_at", (time.time() - self.ttl,)
+        ).fetchall()
+        return iter([(row[0], self._to_waiting(row)) for row in rows])
+
+    def put(self, discord_id: int, waiting: WaitingData) -> None:
+        with self._writing():
+            self._put(discord_id, waiting)
+
+    def _put(self, discord_id: int, waiting: WaitingData) -> None:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("DELETE FROM pending_auth WHERE discord_id = ? OR private_code = ?", (discord_id, waiting.private_code))
+            self._conn.execute(
+                f"INSERT INTO pending_auth ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                (discord_id, waiting.public_code, waiting.private_code, waiting.method, waiting.username, waiting.created_at)
+            )
+            overflow = self._conn.execute("SELECT COUNT(*) FROM pending_auth").fetchone()[0] - self.maxsize
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM pending_auth WHERE discord_id IN (SELECT discord_id FROM pending_auth ORDER BY created_at LIMIT ?)", (overflow,)
+                )
+                self.evictions += overflow
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def get(self, discord_id: int) -> Optional[WaitingData]:
+        row = self._conn.execute(
+            f"SELECT {self._COLUMNS} FROM pending_auth WHERE discord_id = ? AND created_at > ?", (discord_id, time.time() - self.ttl)
+        ).fetchone()
+        return self._to_waiting(row) if row else None
+
+    def _pop_where(self, condition: str, value) -> Optional[tuple[int, WaitingData]]:
+        # 取得と削除を同じ書き込みトランザクションで行い、他のプロセスと二重に取り出さないようにする
+        with self._writing():
+            rows = self._conn.execute(
+                f"DELETE FROM pending_auth WHERE {condition} = ? AND created_at > ? RETURNING {self._COLUMNS}", (value, time.time() - self.ttl)
+            ).fetchall()
+        return (rows[0][0], self._to_waiting(rows[0])) if rows else None
+
+    def pop(self, discord_id: int) -> Optional[WaitingData]:
+        found = self._pop_where("discord_id", discord_id)
+        return found[1] if found else None
+
+    def pop_by_private_code(self, private_code: str) -> Optional[tuple[int, WaitingData]]:
+        return self._pop_where("private_code", private_code)
+
+    def sweep(self) -> int:
+        with self._writing():
+            removed = self._conn.execute("DELETE FROM pending_auth WHERE created_at <= ?", (time.time() - self.ttl,)).rowcount
+        self.expirations += removed
+        return removed
+
+
+def create_pending_auth_store() -> PendingAuthStore:
+    """環境変数の設定に合わせてストアを作成します
+
+    'SCRATCH_AUTH_STATE_BACKEND'に'sqlite'を指定すると、'SCRATCH_AUTH_STATE_PATH'(省略時はdata/pending_auth.sqlite3)に保存します。
+
+    Raises:
+        ValueError: 不明なバックエンドが指定された場合
+    """
+    backend = os.environ.get("SCRATCH_AUTH_STATE_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryPendingAuthStore()
+    if backend == "sqlite":
+        return SQLitePendingAuthStore(os.environ.get("SCRATCH_AUTH_STATE_PATH") or data_path("pending_auth.sqlite3"))
+    raise ValueError(f"認証待ちの保存先 {backend} は無効です")
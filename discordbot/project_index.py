@@ -0,0 +1,107 @@
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+
+@dataclass
+class IndexedProject:
+    id: int
+    author: str
+    title: str
+    moderation_status: Optional[str] = None
+    checked_at: float = 0.0
+
+    def __str__(self) -> str:
+        return f"{self.title} ({self.id})"
+
+
+class ProjectIndex:
+    def __init__(self, path: str):
+        """スタジオの作品を保存するローカルのインデックス
+
+        作品の並び順はスタジオと同じく、追加が新しい順です。
+
+        Args:
+            path (str): SQLiteファイルのパス
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS projects (
+                studio_id TEXT NOT NULL,
+                project_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                author TEXT NOT NULL,
+                title TEXT NOT NULL,
+                moderation_status TEXT,
+                checked_at REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (studio_id, project_id)
+            );
+            CREATE INDEX IF NOT EXISTS projects_seq ON projects (studio_id, seq);
+            CREATE TABLE IF NOT EXISTS scans (
+                studio_id TEXT PRIMARY KEY,
+                scanned_at REAL NOT NULL
+            );
+        """)
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def count(self, studio_id: str) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM projects WHERE studio_id = ?", (studio_id,)).fetchone()[0]
+
+    def known_ids(self, studio_id: str) -> set[int]:
+        rows = self._conn.execute("SELECT project_id FROM projects WHERE studio_id = ?", (studio_id,))
+        return {row[0] for row in rows}
+
+    def stale_ids(self, studio_id: str, max_age: float) -> list[int]:
+        """最後の確認からmax_age秒以上たった作品のIDを返します"""
+        rows = self._conn.execute(
+            "SELECT project_id FROM projects WHERE studio_id = ? AND checked_at < ? ORDER BY seq DESC",
+            (studio_id, time.time() - max_age)
+        )
+        return [row[0] for row in rows]
+
+    def last_scan(self, studio_id: str) -> Optional[float]:
+        row = self._conn.execute("SELECT scanned_at FROM scans WHERE studio_id = ?", (studio_id,)).fetchone()
+        return row[0] if row else None
+
+    def list_projects(self, studio_id: str) -> list[IndexedProject]:
+        """新しい順に作品を返します"""
+        rows = self._conn.execute(
+            "SELECT project_id, author, title, moderation_status, checked_at FROM projects WHERE studio_id = ? ORDER BY seq DESC",
+            (studio_id,)
+        )
+        return [IndexedProject(*row) for row in rows]
+
+    def add_projects(self, studio_id: str, projects: list[IndexedProject], *, replace: bool = False) -> None:
+        """作品を追加します
+
+        Args:
+            studio_id (str): スタジオのID
+            projects (list[IndexedProject]): 追加する作品。新しい順
+            replace (bool, optional): Trueの場合、既存の作品をすべて置き換えます
+        """
+        with self._conn:
+            if replace:
+                self._conn.execute("DELETE FROM projects WHERE studio_id = ?", (studio_id,))
+                base = 0
+            else:
+                base = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM projects WHERE studio_id = ?", (studio_id,)).fetchone()[0]
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO projects (studio_id, project_id, seq, author, title, moderation_status, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(studio_id, p.id, base + len(projects) - i, p.author, p.title, p.moderation_status, p.checked_at) for i, p in enumerate(projects)]
+            )
+            self._conn.execute("INSERT OR REPLACE INTO scans (studio_id, scanned_at) VALUES (?, ?)", (studio_id, time.time()))
+
+    def update_statuses(self, studio_id: str, statuses: Iterable[tuple[int, Optional[str]]], checked_at: Optional[float] = None) -> None:
+        checked_at = checked_at or time.time()
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE projects SET moderation_status = ?, checked_at = ? WHERE studio_id = ? AND project_id = ?",
+                [(status, checked_at, studio_id, project_id) for project_id, status in statuses]
+            )
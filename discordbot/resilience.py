@@ -0,0 +1,187 @@
+import asyncio
+import random
+import time
+from logging import getLogger, StreamHandler, DEBUG
+from typing import Awaitable, Callable, Literal, Optional, TypeVar
+
+import aiohttp
+
+from discordbot.metrics import metrics
+
+logger = getLogger(__name__)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+T = TypeVar("T")
+
+# 通信の失敗として扱う例外
+TRANSIENT_ERRORS = (ConnectionError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class CircuitOpenError(ConnectionError):
+    """サーキットブレーカーが開いているため、通信しなかった場合の例外"""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, *, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """連続して失敗した通信先への呼び出しを一時的に止めます
+
+        failure_threshold回続けて失敗すると開き、reset_timeout秒の間はすぐに失敗させます。
+        その後は1回だけ試し、成功すれば閉じ、失敗すれば再び開きます。
+
+        Args:
+            name (str): ログや計測値に使う名前
+            failure_threshold (int, optional): 開くまでの連続失敗回数
+            reset_timeout (float, optional): 開いてから再び試すまでの秒数
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> Literal["closed", "open", "half_open"]:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    @property
+    def available(self) -> bool:
+        """呼び出せる見込みがあるか。試す権利は消費しません。"""
+        return self.state != "open"
+
+    def before_call(self) -> None:
+        """呼び出してよいかを確認します
+
+        Raises:
+            CircuitOpenError: 開いている場合、または試している呼び出しがすでにある場合
+        """
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self._trial:
+            self._trial = True
+            return
+        metrics.incr(f"{self.name}.circuit_rejected")
+        raise CircuitOpenError(f"{self.name} は一時的に利用できません")
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"{self.name} のサーキットブレーカーを閉じました")
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def release(self) -> None:
+        """通信の成否が分からないまま終わった場合に、試す権利を戻します"""
+        self._trial = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._trial:
+                logger.warning(f"{self.name} のサーキットブレーカーを開きました 連続失敗: {self.failures}")
+                metrics.incr(f"{self.name}.circuit_opened")
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+
+class ResilientCaller:
+    def __init__(self, name: str, *, timeout: float = 5.0, retries: int = 2, backoff: float = 0.3, max_backoff: float = 3.0,
+                 hedge_after: Optional[float] = None, breaker: Optional[CircuitBreaker] = None):
+        """タイムアウト、再試行、ヘッジ、サーキットブレーカーをまとめて適用します
+
+        Args:
+            name (str): ログや計測値に使う名前
+            timeout (float, optional): 1回の呼び出しのタイムアウト(秒)
+            retries (int, optional): 冪等な呼び出しを再試行する回数
+            backoff (float, optional): 再試行の待ち時間の基準(秒)。回数ごとに倍にし、0からその値までの乱数で待ちます
+            max_backoff (float, optional): 再試行の待ち時間の上限(秒)
+            hedge_after (Optional[float], optional): 冪等な呼び出しがこの秒数で終わらない場合に、2つ目を並行して送ります。Noneの場合は送りません
+            breaker (Optional[CircuitBreaker], optional): 使用するサーキットブレーカー。省略時は新しく作成します
+        """
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker(name)
+
+    async def _attempt(self, func: Callable[[], Awaitable[T]]) -> T:
+        return await asyncio.wait_for(func(), self.timeout)
+
+    async def _hedged(self, func: Callable[[], Awaitable[T]]) -> T:
+        first = asyncio.create_task(self._attempt(func))
+        done, _ = await asyncio.wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+
+        metrics.incr(f"{self.name}.hedged")
+        second = asyncio.create_task(self._attempt(func))
+        tasks = {first, second}
+        try:
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            metrics.incr(f"{self.name}.hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in (first, second):
+                task.cancel()
+
+    async def call(self, func: Callable[[], Awaitable[T]], *, idempotent: bool = False) -> T:
+        """funcを呼び出します
+
+        冪等でない呼び出しは再試行もヘッジもせず、1回だけ送ります。
+
+        Args:
+            func (Callable[[], Awaitable[T]]): 呼び出すたびに新しいリクエストを送るコルーチン関数。失敗はTRANSIENT_ERRORSで知らせます
+            idempotent (bool, optional): 何度送っても結果が変わらない呼び出しか
+
+        Raises:
+            CircuitOpenError: サーキットブレーカーが開いている場合
+            ConnectionError: 再試行しても失敗した場合
+
+        Returns:
+            T: funcの結果
+        """
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            self.breaker.before_call()
+            start = time.perf_counter()
+            try:
+                if idempotent and self.hedge_after is not None:
+                    result = await self._hedged(func)
+                else:
+                    result = await self._attempt(func)
+            except TRANSIENT_ERRORS as e:
+                self.breaker.record_failure()
+                metrics.incr(f"{self.name}.failures")
+                if attempt + 1 >= attempts or not self.breaker.available:
+                    raise ConnectionError(f"{self.name} との通信に失敗しました {e!r}") from e
+
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logger.info(f"{self.name} との通信に失敗したため、{delay:.2f}秒後に再試行します {e!r}")
+                metrics.incr(f"{self.name}.retries")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+
+            self.breaker.record_success()
+            metrics.observe(f"{self.name}.latency", time.perf_counter() - start)
+            return result
@@ -0,0 +1,61 @@
+import re
+from typing import Literal
+
+ScratchLinkType = Literal["projects", "users", "studios"]
+
+# <https://...>のように埋め込みを抑制したURLや、/editorや#fullscreenが続くURLも対象にする
+SCRATCH_LINK = re.compile(r"https?://(?:www\.)?scratch\.mit\.edu/(projects|users|studios)/([a-zA-Z0-9\-_]+)")
+
+
+def extract_scratch_links(text: str) -> list[tuple[ScratchLinkType, str]]:
+    """テキストに含まれるScratchのURLを(タイプ, ID)にして返します
+
+    1回の走査で取り出し、同じ対象を指すものは最初の1つにまとめます。ユーザー名は小文字にそろえます。
+
+    Args:
+        text (str): ScratchのURLを含むテキスト
+
+    Returns:
+        list[tuple[ScratchLinkType, str]]: テキスト中の出現順の(タイプ, ID)
+    """
+    # 正規表現を使う前に、部分文字列の検索だけで大半のメッセージを除外する
+    if "scratch.mit.edu" not in text:
+        return []
+    return list(dict.fromkeys(_normalize(match.group(1), match.group(2)) for match in SCRATCH_LINK.finditer(text)))
+
+
+def _normalize(link_type: ScratchLinkType, link_id: str) -> tuple[ScratchLinkType, str]:
+    if link_type == "users":
+        return link_type, link_id.lower()
+    return link_type, link_id
+
+
+if __name__ == "__main__":
+    import random
+    import timeit
+
+    samples = [
+        "たーけクラウドシステムがサービス再開するらしいよ https://scratch.mit.edu/projects/870204802/",
+        "<https://www.scratch.mit.edu/projects/870204802/editor> と https://scratch.mit.edu/projects/870204802/#fullscreen",
+        "https://scratch.mit.edu/users/Takechi_cloud/ https://scratch.mit.edu/studios/34105421/comments",
+        "今日はいい天気ですね",
+        "https://example.com/projects/1/ は対象外",
+    ]
+    for sample in samples:
+        print(extract_scratch_links(sample), sample)
+
+    random.seed(0)
+    filler = "あいうえおかきくけこ abc def ghi " * 20
+    corpus = [random.choice(samples) + filler if random.random() < 0.2 else filler for _ in range(10000)]
+
+    # 以前の実装: 検出用と解析用の2つの正規表現で処理する
+    def legacy(text: str) -> list[tuple[str, str]]:
+        links = {}
+        for match in re.finditer(r"https?://scratch\.mit\.edu/(projects|users|studios)/[a-zA-Z0-9\-_]+/*", text):
+            parsed = re.search(r"(https?://scratch\.mit\.edu/)(projects|users|studios)/([a-zA-Z0-9\-_]+)/*", match.group(0))
+            links.setdefault((parsed.group(2), parsed.group(3)), None)
+        return list(links)
+
+    for name, func in [("legacy", legacy), ("extract_scratch_links", extract_scratch_links)]:
+        seconds = min(timeit.repeat(lambda: [func(text) for text in corpus], number=1, repeat=5))
+        print(f"{name}: {seconds * 1000:.1f}ms / {len(corpus)}件")
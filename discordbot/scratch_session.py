@@ -0,0 +1,87 @@
+import warnings
+from typing import Optional
+
+import aiohttp
+
+from discordbot.lazy_import import lazy_import
+
+scapi = lazy_import("scapi")
+
+_session_class: Optional[type] = None
+
+
+def _tuned_session_class() -> type:
+    """接続プールを指定できるscapi.ClientSessionを返します
+
+    scapi.ClientSessionは__init__でconnectorを渡せないため、同じ初期化をconnector付きで行います。
+    scapiの読み込みを遅らせるため、最初に使うときに作成します。
+    """
+    global _session_class
+    if _session_class is not None:
+        return _session_class
+
+    with warnings.catch_warnings():
+        # aiohttpはClientSessionの継承に警告を出すが、scapi自身が継承しているため避けられない
+        warnings.simplefilter("ignore", DeprecationWarning)
+
+        class TunedClientSession(scapi.ClientSession):
+            def __init__(self, connector: aiohttp.BaseConnector, header: dict, cookie: dict, protect: bool = True) -> None:
+                aiohttp.ClientSession.__init__(self, connector=connector)
+                self._header = header
+                self._cookie = cookie
+                self._proxy = None
+                self._proxy_auth = None
+                self.protect = protect
+
+    _session_class = TunedClientSession
+    return _session_class
+
+
+class ScratchSession:
+    def __init__(self, *, limit: int = 50, limit_per_host: int = 20, ttl_dns_cache: int = 300, keepalive_timeout: float = 60.0):
+        """Scratchへの問い合わせで共有するscapiのセッション
+
+        scapiの関数はセッションを渡さないと呼び出しごとに新しく作成し、閉じないため、
+        Botで1つのセッションを持ち、すべての問い合わせでTLS接続を使い回します。
+
+        Args:
+            limit (int, optional): 全体の同時接続数の上限
+            limit_per_host (int, optional): ホストごとの同時接続数の上限
+            ttl_dns_cache (int, optional): DNSの結果を保持する秒数
+            keepalive_timeout (float, optional): 使い終わった接続を保持する秒数
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    def get(self) -> "scapi.ClientSession":
+        """共有のセッションを返します。まだない場合や閉じられている場合は作成します。
+
+        イベントループの中で呼び出してください。
+        """
+        if self.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            from scapi.others.common import headers
+            self._session = _tuned_session_class()(connector, header=headers, cookie={"scratchcsrftoken": "a"}, protect=True)
+        return self._session
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        await self._session.close()
+        self._session = None
+
+
+# ホットリロードでモジュールが再読み込みされても、開いているセッションを引き継ぐ
+scratch_session: ScratchSession = globals().get("scratch_session") or ScratchSession()
@@ -0,0 +1,47 @@
+import time
+from typing import Optional
+
+from discordbot.metrics import metrics
+
+# 起動処理の最初に読み込むことで、ほかのimportにかかる時間も記録できる
+IMPORTED_AT = time.perf_counter()
+
+
+class StartupProfile:
+    def __init__(self, started_at: Optional[float] = None):
+        """起動から準備完了までの時間を段階ごとに記録します
+
+        Args:
+            started_at (Optional[float], optional): 起動した時刻(time.perf_counter)。省略時はこのモジュールを読み込んだ時刻
+        """
+        self.started_at = started_at if started_at is not None else IMPORTED_AT
+        self._last = self.started_at
+        self.phases: dict[str, float] = {}
+        self.details: dict[str, float] = {}
+        self.reported = False
+
+    def mark(self, phase: str) -> None:
+        """前回の記録からここまでをphaseとして記録します"""
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def detail(self, name: str, seconds: float) -> None:
+        """段階の内訳(Cogごとの読み込み時間など)を記録します"""
+        self.details[name] = seconds
+
+    @property
+    def total(self) -> float:
+        return self._last - self.started_at
+
+    def report(self) -> str:
+        """記録した時間を整形し、計測値にも記録します"""
+        self.reported = True
+        for phase, seconds in self.phases.items():
+            metrics.observe(f"startup.{phase}", seconds)
+        metrics.observe("startup.total", self.total)
+
+        lines = [f"起動時間 合計: {self.total * 1000:.0f}ms"]
+        lines += [f"  {phase}: {seconds * 1000:.0f}ms" for phase, seconds in self.phases.items()]
+        lines += [f"    {name}: {seconds * 1000:.0f}ms" for name, seconds in self.details.items()]
+        return "\n".join(lines)
@@ -0,0 +1,17 @@
+import os
+
+
+def data_path(filename: str) -> str:
+    """Botが保存するファイルのパスを返します
+
+    環境変数'DISCORD_DATA_DIR'で保存先を変更できます。未設定の場合はリポジトリ直下のdataディレクトリです。
+
+    Args:
+        filename (str): ファイル名
+
+    Returns:
+        str: 保存先のパス
+    """
+    data_dir = os.environ.get("DISCORD_DATA_DIR") or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, filename)
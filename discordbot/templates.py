@@ -1,10 +1,14 @@
 import os
 import functools
+import inspect
+import time
+from typing import Callable, Optional, Union
 
 from discord import Embed
 from discord.ext.commands import Bot
 import discord
 
+from discordbot.metrics import metrics
 
 try:
     discord_cs_server_id = int(os.environ["DISCORD_CS_SERVERID"])
@@ -26,34 +30,126 @@ class EmojiTemplates:
         self.auth_profile_comment = bot.get_emoji(1331105604646998026)
 
 
+class RoleIndex:
+    """ギルドごとのロール名からロールIDを引く索引
+
+    ギルドごとに最初の参照時に作成し、以降はロールの作成・更新・削除イベントで更新します。
+    切断中の変更はイベントで届かないため、再接続でギルドが利用可能になったときに破棄し、次の参照時に作り直します。
+    """
+
+    def __init__(self):
+        self._guilds: dict[int, dict[str, set[int]]] = {}
+
+    def _names(self, guild: discord.Guild) -> dict[str, set[int]]:
+        names = self._guilds.get(guild.id)
+        if names is None:
+            names = {}
+            for role in guild.roles:
+                names.setdefault(role.name, set()).add(role.id)
+            self._guilds[guild.id] = names
+        return names
+
+    def get_role(self, guild: discord.Guild, name: str) -> Optional[discord.Role]:
+        """名前からロールを取得します。同名のロールがある場合は最も下のものを返します。"""
+        roles = [guild.get_role(role_id) for role_id in self._names(guild).get(name, ())]
+        roles = [role for role in roles if role is not None]
+        return min(roles, default=None)
+
+    def member_has_role(self, member: Union[discord.Member, discord.User], name: str) -> bool:
+        if not isinstance(member, discord.Member):
+            return False
+        return any(member.get_role(role_id) is not None for role_id in self._names(member.guild).get(name, ()))
+
+    def _add(self, role: discord.Role) -> None:
+        names = self._guilds.get(role.guild.id)
+        if names is not None:
+            names.setdefault(role.name, set()).add(role.id)
+
+    def _discard(self, role: discord.Role) -> None:
+        names = self._guilds.get(role.guild.id)
+        if names is not None and role.name in names:
+            names[role.name].discard(role.id)
+            if not names[role.name]:
+                del names[role.name]
+
+    async def on_guild_role_create(self, role: discord.Role) -> None:
+        self._add(role)
+
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role) -> None:
+        self._discard(before)
+        self._add(after)
+
+    async def on_guild_role_delete(self, role: discord.Role) -> None:
+        self._discard(role)
+
+    async def on_guild_remove(self, guild: discord.Guild) -> None:
+        self._guilds.pop(guild.id, None)
+
+    async def on_guild_available(self, guild: discord.Guild) -> None:
+        self._guilds.pop(guild.id, None)
+
+    async def on_ready(self) -> None:
+        self._guilds.clear()
+
+    def attach(self, bot: Bot) -> None:
+        """Botのイベントに登録します"""
+        bot.add_listener(self.on_guild_role_create)
+        bot.add_listener(self.on_guild_role_update)
+        bot.add_listener(self.on_guild_role_delete)
+        bot.add_listener(self.on_guild_remove)
+        bot.add_listener(self.on_guild_available)
+        bot.add_listener(self.on_ready)
+
+
+# ホットリロードでモジュールが再読み込みされても、Botに登録済みの索引を引き継ぐ
+role_index: RoleIndex = globals().get("role_index") or RoleIndex()
+
+
 def _command_is_cs_admin(interaction: discord.Interaction):
     return (interaction.guild is not None and
             interaction.guild.id == discord_cs_server_id and
-            discord.utils.get(interaction.user.roles, name="admin")
+            role_index.member_has_role(interaction.user, "admin")
             )
 
 
+def _compile_policy(only_admin: bool, only_cloudserver: bool, allow_dm: bool) -> Callable[[discord.Interaction], Optional[Embed]]:
+    """limit_commandの条件を1つの判定関数にまとめます。拒否する場合は送信する埋め込みを返します。"""
+    if not (only_admin or only_cloudserver or not allow_dm):
+        return lambda interaction: None
+
+    def policy(interaction: discord.Interaction) -> Optional[Embed]:
+        if only_admin and not _command_is_cs_admin(interaction):
+            return EmbedTemplates.no_permission
+
+        guild = interaction.guild
+        if guild is None:
+            return None if allow_dm else EmbedTemplates.dm
+
+        if only_cloudserver and guild.id != discord_cs_server_id:
+            return EmbedTemplates.outside_cs
+        return None
+
+    return policy
+
+
 def limit_command(only_admin=False, only_cloudserver=False, allow_dm=True):
+    policy = _compile_policy(only_admin, only_cloudserver, allow_dm)
+
     def decorator(f):
+        # interactionの位置はデコレート時に決めておく
+        parameters = list(inspect.signature(f).parameters)
+        position = parameters.index("interaction") if "interaction" in parameters else 0
+        metric_name = f"limit_command.{f.__name__}"
+
         @functools.wraps(f)
         async def wrapper(*args, **kwargs):
-            # 位置引数の中からinteractionを取得
-            interaction = [arg for arg in args if isinstance(arg, discord.Interaction)][0]
-
-            # もしなければキーワード引数から取得
-            if interaction is None:
-                interaction = kwargs.get('interaction')
-
-            if only_admin and not _command_is_cs_admin(interaction):
-                await interaction.response.send_message(embed=EmbedTemplates.no_permission, ephemeral=True)
-                return
-
-            if not allow_dm and interaction.guild is None:
-                await interaction.response.send_message(embed=EmbedTemplates.dm, ephemeral=True)
-                return
+            start = time.perf_counter()
+            interaction = args[position] if position < len(args) else kwargs["interaction"]
+            denied = policy(interaction)
+            metrics.observe(metric_name, time.perf_counter() - start)
 
-            if only_cloudserver and interaction.guild is not None and interaction.guild.id != discord_cs_server_id:
-                await interaction.response.send_message(embed=EmbedTemplates.outside_cs, ephemeral=True)
+            if denied is not None:
+                await interaction.response.send_message(embed=denied, ephemeral=True)
                 return
             return await f(*args, **kwargs)
 
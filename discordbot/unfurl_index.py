@@ -0,0 +1,122 @@
+import datetime
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+import discord
+
+
+@dataclass
+class UnfurlEntry:
+    author_id: Optional[int]
+    origin_id: Optional[int]
+
+
+class UnfurlIndex:
+    def __init__(self, maxsize: int = 5000):
+        """Botが送信した削除可能な埋め込みと、元メッセージの送信者の対応
+
+        Botの起動後に送信したものはすべて記録されるため、horizonより新しく記録のないメッセージは削除対象外と判断できます。
+
+        Args:
+            maxsize (int, optional): 保持する最大件数。超えた場合は古いものから削除
+        """
+        self.maxsize = maxsize
+        self._entries: OrderedDict[int, UnfurlEntry] = OrderedDict()
+        self._by_origin: dict[int, int] = {}
+        # これより古いメッセージは記録がない可能性がある
+        self.horizon: int = discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, message_id: int, author_id: Optional[int], origin_id: Optional[int] = None) -> None:
+        """送信した埋め込みを記録します
+
+        Args:
+            message_id (int): Botが送信したメッセージのID
+            author_id (Optional[int]): 削除できる人のDiscordID。Noneの場合は誰でも削除可能
+            origin_id (Optional[int], optional): 返信元のメッセージのID
+        """
+        self._entries[message_id] = UnfurlEntry(author_id=author_id, origin_id=origin_id)
+        self._entries.move_to_end(message_id)
+        if origin_id is not None:
+            self._by_origin[origin_id] = message_id
+
+        while len(self._entries) > self.maxsize:
+            evicted_id, evicted = self._entries.popitem(last=False)
+            if evicted.origin_id is not None:
+                self._by_origin.pop(evicted.origin_id, None)
+            self.horizon = max(self.horizon, evicted_id + 1)
+
+    def get(self, message_id: int) -> Optional[UnfurlEntry]:
+        return self._entries.get(message_id)
+
+    def reply_for(self, origin_id: int) -> Optional[int]:
+        """元メッセージへの返信として送信した埋め込みのID"""
+        return self._by_origin.get(origin_id)
+
+    def covers(self, message_id: int) -> bool:
+        """記録がなければBotの削除可能な埋め込みではないと判断できるか"""
+        return message_id >= self.horizon
+
+    def on_message_deleted(self, message_id: int) -> None:
+        """メッセージの削除を反映します
+
+        埋め込みが削除された場合は記録を消し、元メッセージが削除された場合は誰でも削除できるようにします。
+        """
+        entry = self._entries.pop(message_id, None)
+        if entry is not None and entry.origin_id is not None:
+            self._by_origin.pop(entry.origin_id, None)
+
+        reply_id = self._by_origin.pop(message_id, None)
+        if reply_id is not None and reply_id in self._entries:
+            self._entries[reply_id].author_id = None
+
+
+@dataclass
+class UnfurlRecord:
+    # Noneの場合は返信が削除済みで、再び展開しない
+    reply_id: Optional[int]
+    links: list[tuple[str, str]]
+    embeds: dict[tuple[str, str], discord.Embed]
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class UnfurlRecords:
+    def __init__(self, maxsize: int = 1000, max_age: float = 24 * 60 * 60):
+        """元メッセージごとに、返信した埋め込みとその元になったリンクを記録します
+
+        メッセージが編集されたときに、増えたリンクだけを取得して返信を編集するために使います。
+
+        Args:
+            maxsize (int, optional): 保持する最大件数。超えた場合は古いものから削除
+            max_age (float, optional): 保持する秒数
+        """
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self._records: OrderedDict[int, UnfurlRecord] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _trim(self) -> None:
+        expires = time.monotonic() - self.max_age
+        while self._records:
+            origin_id, record = next(iter(self._records.items()))
+            if len(self._records) <= self.maxsize and record.created_at > expires:
+                break
+            del self._records[origin_id]
+
+    def add(self, origin_id: int, record: UnfurlRecord) -> None:
+        self._records.pop(origin_id, None)
+        self._records[origin_id] = record
+        self._trim()
+
+    def get(self, origin_id: int) -> Optional[UnfurlRecord]:
+        self._trim()
+        return self._records.get(origin_id)
+
+    def pop(self, origin_id: int) -> Optional[UnfurlRecord]:
+        return self._records.pop(origin_id, None)
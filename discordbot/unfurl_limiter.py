@@ -0,0 +1,117 @@
+import asyncio
+from collections import OrderedDict
+from typing import Hashable
+
+from discordbot.metrics import metrics
+from discordbot.ratelimit import TokenBucket
+
+
+class UnfurlLimiter:
+    def __init__(self, *, user_rate: float = 0.2, user_capacity: float = 5, channel_rate: float = 0.5, channel_capacity: float = 10,
+                 global_rate: float = 2.0, global_capacity: float = 20, max_pending: int = 20, max_wait: float = 10.0,
+                 max_buckets: int = 10000):
+        """埋め込みの展開でScratchへ問い合わせる件数を、ユーザー・チャンネル・全体ごとに制限します
+
+        トークンはキャッシュにない対象1件につき1つ消費し、残っているトークンの分だけ問い合わせを許可します。
+        許可されなかった対象は、キャッシュにあるものだけで応答させます。
+        チャンネルか全体のトークンがない場合は待機列に入れ、待機列が埋まっている場合や、
+        待ち時間が上限を超えた場合は1件も問い合わせさせず、消費したトークンを戻します。
+
+        Args:
+            user_rate (float, optional): ユーザーごとの1秒あたりの件数
+            user_capacity (float, optional): ユーザーごとに一度に使える件数
+            channel_rate (float, optional): チャンネルごとの1秒あたりの件数
+            channel_capacity (float, optional): チャンネルごとに一度に使える件数
+            global_rate (float, optional): 全体の1秒あたりの件数
+            global_capacity (float, optional): 全体で一度に使える件数
+            max_pending (int, optional): 待機列に入れる最大数
+            max_wait (float, optional): 待機列で待つ最大秒数
+            max_buckets (int, optional): ユーザー・チャンネルごとに保持するバケットの最大数
+        """
+        self.user_rate = user_rate
+        self.user_capacity = user_capacity
+        self.channel_rate = channel_rate
+        self.channel_capacity = channel_capacity
+        self.global_bucket = TokenBucket(global_rate, global_capacity)
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.max_buckets = max_buckets
+        self.pending = 0
+
+        self._users: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+        self._channels: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+
+    def _bucket(self, buckets: OrderedDict[Hashable, TokenBucket], key: Hashable, rate: float, capacity: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, capacity)
+            # 使われていないものから削除する。満タンのバケットは新しく作ったものと変わらない
+            while len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    async def _acquire_shared(self, channel: TokenBucket, cost: float) -> None:
+        await channel.acquire(cost)
+        try:
+            await self.global_bucket.acquire(cost)
+        except BaseException:
+            # タイムアウトで中断された場合、チャンネルの分を戻す
+            channel.refund(cost)
+            raise
+
+    async def admit(self, user_id: int, channel_id: int, cost: int) -> int:
+        """問い合わせてよい件数を判定します。必要なら待機します。
+
+        Args:
+            user_id (int): メッセージの送信者のID
+            channel_id (int): メッセージのチャンネルのID
+            cost (int): キャッシュにない対象の件数
+
+        Returns:
+            int: 問い合わせてよい件数(0以上cost以下)。残りはキャッシュのみで応答する
+        """
+        if cost <= 0:
+            return 0
+
+        user = self._bucket(self._users, user_id, self.user_rate, self.user_capacity)
+        granted = min(cost, int(user.tokens))
+        if granted <= 0:
+            metrics.incr("unfurl_limit.throttled.user")
+            return 0
+        user.try_acquire(granted)
+
+        channel = self._bucket(self._channels, channel_id, self.channel_rate, self.channel_capacity)
+        shared = min(granted, int(channel.tokens), int(self.global_bucket.tokens))
+        if shared > 0:
+            channel.try_acquire(shared)
+            self.global_bucket.try_acquire(shared)
+            user.refund(granted - shared)
+            if shared < cost:
+                metrics.incr("unfurl_limit.partial")
+            return shared
+
+        metrics.incr("unfurl_limit.throttled.channel" if channel.tokens < 1 else "unfurl_limit.throttled.global")
+        if self.pending >= self.max_pending:
+            metrics.incr("unfurl_limit.shed.queue_full")
+            user.refund(granted)
+            return 0
+
+        # 待つのは1件分だけにし、待ち時間を短くする
+        self.pending += 1
+        metrics.gauge("unfurl_limit.pending", self.pending)
+        try:
+            await asyncio.wait_for(self._acquire_shared(channel, 1), self.max_wait)
+            metrics.incr("unfurl_limit.queued")
+            user.refund(granted - 1)
+            if cost > 1:
+                metrics.incr("unfurl_limit.partial")
+            return 1
+        except asyncio.TimeoutError:
+            metrics.incr("unfurl_limit.shed.timeout")
+            user.refund(granted)
+            return 0
+        finally:
+            self.pending -= 1
+            metrics.gauge("unfurl_limit.pending", self.pending)